@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mysystem import utils
+
+
+def compare(name: str, res: np.ndarray, expected: pd.DataFrame, tol: float = 1e-9) -> None:
+    '''
+    检查res与pandas的结果是否一致: NaN的位置相同, 其余位置的相对误差(绝对值小于1时为绝对误差)不超过tol
+    '''
+    expected = expected.values
+    assert (np.isnan(res) == np.isnan(expected)).all(), f'{name}: NaN positions differ from pandas'
+    error = np.nanmax(np.abs(res - expected) / np.maximum(np.abs(expected), 1), initial = 0)
+    assert error <= tol, f'{name}: max error {error:.3g} against pandas'
+    print(f'{name:28s} OK, max error {error:.3g}')
+
+
+def check_rolling(seed: int = 0) -> None:
+    '''
+    时序算子与pd.DataFrame.rolling(d)的结果对比, 数据中包含NaN, +inf, -inf和极端值
+    '''
+    rng = np.random.default_rng(seed)
+    x, y = rng.standard_normal((300, 600)), rng.standard_normal((300, 600))
+    x[:, 300:][rng.random((300, 300)) < 0.05] = np.nan
+    y[:, 300:][rng.random((300, 300)) < 0.05] = np.nan
+    x[: 120, 10: 100] = np.nan # 区间内上市的股票
+    x[10, 0], x[13, 1], x[150, 2], x[160, 2] = np.inf, -np.inf, np.inf, -np.inf
+    x[:, 3], x[:, 4], y[200, 5] = np.inf, np.nan, -np.inf
+    X, Y = pd.DataFrame(x), pd.DataFrame(y)
+    for d in (5, 20, 250, 400):
+        compare(f'ts_sum({d})', utils.ts_sum(x, d), X.rolling(d).sum())
+        compare(f'ts_mean({d})', utils.ts_mean(x, d), X.rolling(d).mean())
+        compare(f'ts_std({d})', utils.ts_std(x, d), X.rolling(d).std())
+        compare(f'ts_corr({d})', utils.ts_corr(x, y, d), X.rolling(d).corr(Y))
+
+    # 极端值只影响包含它的窗口的精度; pandas的滚动方差在极端值移出窗口后仍有误差, 因此与逐个窗口直接计算的结果对比
+    z = rng.standard_normal((300, 1))
+    z[100] = 1e12
+    windows = np.lib.stride_tricks.sliding_window_view(z[:, 0], 5)
+    for name, res, expected in [('ts_sum(5) with outlier', utils.ts_sum(z, 5), windows.sum(axis = 1)),
+                                ('ts_std(5) with outlier', utils.ts_std(z, 5), windows.std(axis = 1, ddof = 1))]:
+        compare(name, res[4:], pd.DataFrame(expected[:, None]))
+
+if __name__ == '__main__':
+    check_rolling()
+    print('Successfully check all operators against pandas')
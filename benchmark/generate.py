@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+import os
+import argparse
+
+
+def stock_ids(n_stocks: int, n_bj: int = 0) -> list:
+    '''
+    生成与沪深市场格式相同的股票代码, 例如'000001.SZ', '300001.SZ', '600000.SH', '688001.SH',
+    另外生成n_bj只北交所股票(构建dataset时会被去掉)
+    '''
+    boards = [('000000', 'SZ'), ('300000', 'SZ'), ('600000', 'SH'), ('688000', 'SH')]
+    ids = [f'{int(boards[k % 4][0]) + k // 4 + 1:06d}.{boards[k % 4][1]}' for k in range(n_stocks)]
+    ids += [f'{830000 + k:06d}.BJ' for k in range(n_bj)]
+    return sorted(ids)
+
+
+def generate(ROOT: str, n_stocks: int = 5000, n_days: int = 750, seed: int = 0) -> str:
+    '''
+    生成模拟的A股日行情数据, 停牌数据和沪深300成分股数据, 文件格式与真实数据相同: \n
+    ROOT/data/stk_daily.feather: 长表格式的日行情, 包含stk_id, date, open, high, low, close, volume, amount, cumadj \n
+    ROOT/quantitative_trading_system/newdata/suspend.csv: 停牌数据, 1表示停牌 \n
+    ROOT/quantitative_trading_system/newdata/hs300.csv: 沪深300成分股, 每半年调整一次 \n
+    n_stocks: 沪深股票个数, 部分股票在区间内上市或退市 \n
+    n_days: 交易日个数, 从2020-01-02开始 \n
+    返回可以传给get_data, Backtest, AlphaPool的PATH
+    '''
+    rng = np.random.default_rng(seed)
+    PATH = os.path.join(ROOT, 'quantitative_trading_system')
+    os.makedirs(os.path.join(ROOT, 'data'), exist_ok = True)
+    os.makedirs(os.path.join(PATH, 'newdata'), exist_ok = True)
+    dates = pd.bdate_range('2020-01-02', periods = n_days, name = 'date')
+    ids = stock_ids(n_stocks, n_bj = max(n_stocks // 50, 1))
+    T, N = len(dates), len(ids)
+
+    # 上市和退市: 约20%的股票在区间内上市, 约2%的股票在区间内退市
+    listed = np.ones((T, N), dtype = bool)
+    ipo = rng.random(N) < 0.2
+    listed &= np.arange(T)[:, None] >= np.where(ipo, rng.integers(0, T, N), 0)
+    delist = rng.random(N) < 0.02
+    listed &= np.arange(T)[:, None] < np.where(delist, rng.integers(T // 2, T + 1, N), T + 1)
+
+    # 价格: 复权价格为带涨跌停限制的随机游走, 复权因子偶尔跳升(分红送转), 未复权价格相应下跳
+    daily_ret = np.clip(rng.standard_t(4, (T, N)) * 0.015 + 0.0002, -0.1, 0.1)
+    cumadj = np.cumprod(np.where(rng.random((T, N)) < 0.004, 1 + rng.uniform(0.01, 0.3, (T, N)), 1), axis = 0)
+    close = np.round(np.exp(rng.normal(2.5, 0.8, N)) * np.cumprod(1 + daily_ret, axis = 0) / cumadj, 2)
+    spread = np.abs(rng.normal(0, 0.01, (T, N)))
+    open_ = np.round(close * (1 + rng.normal(0, 0.005, (T, N))), 2)
+    high = np.round(np.maximum(open_, close) * (1 + spread), 2)
+    low = np.round(np.minimum(open_, close) * (1 - spread), 2)
+
+    # 停牌: 以连续若干天的形式出现, 停牌日成交量为0
+    suspend = np.zeros((T, N), dtype = int)
+    starts = np.nonzero(rng.random((T, N)) < 0.0015)
+    for length in range(1, 6): # 停牌天数为1到5天
+        rows = np.minimum(starts[0] + length - 1, T - 1)
+        keep = rng.random(len(rows)) < 0.8 ** (length - 1)
+        suspend[rows[keep], starts[1][keep]] = 1
+    suspend[~listed] = 0
+    volume = np.round(np.exp(rng.normal(15, 1.2, N)) * rng.lognormal(0, 0.5, (T, N)), -2)
+    volume[suspend == 1] = 0
+    amount = volume * (open_ + high + low + close) / 4
+
+    # 转换为长表格式, 打乱行的顺序
+    row, col = np.nonzero(listed)
+    raw = pd.DataFrame({'stk_id': np.asarray(ids, dtype = object)[col], 'date': dates.values[row],
+                        'open': open_[row, col], 'high': high[row, col], 'low': low[row, col],
+                        'close': close[row, col], 'volume': volume[row, col], 'amount': amount[row, col],
+                        'cumadj': cumadj[row, col]})
+    raw = raw.iloc[rng.permutation(len(raw))].reset_index(drop = True)
+    raw.to_feather(os.path.join(ROOT, 'data/stk_daily.feather'))
+    del raw
+
+    # 停牌数据和沪深300成分股只包含沪深股票, 格式与newdata中的notebook保存的格式一致
+    sh_sz = [k for k, x in enumerate(ids) if not x.endswith('BJ')]
+    columns = [ids[k] for k in sh_sz]
+    pd.DataFrame(suspend[:, sh_sz], index = dates, columns = columns).to_csv(
+        os.path.join(PATH, 'newdata/suspend.csv'), index_label = False)
+
+    # 沪深300: 每半年按此前20个交易日的平均成交额调整一次成分股
+    n_member = min(300, len(columns))
+    turnover = np.where(listed, amount, 0)[:, sh_sz]
+    hs300 = np.zeros((T, len(columns)), dtype = bool)
+    period = (dates.year * 2 + (dates.month > 6)).values
+    for p in np.unique(period):
+        loc = np.nonzero(period == p)[0]
+        ref = turnover[max(loc[0] - 20, 0): loc[0] + 1].mean(axis = 0)
+        members = np.argsort(-ref, kind = 'stable')[:n_member]
+        hs300[np.ix_(loc, members)] = True
+    pd.DataFrame(hs300, index = dates, columns = columns).to_csv(
+        os.path.join(PATH, 'newdata/hs300.csv'), index_label = False)
+    return PATH
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'generate synthetic A-share daily data')
+    parser.add_argument('root', help = 'folder to write data/ and quantitative_trading_system/newdata/ into')
+    parser.add_argument('--stocks', type = int, default = 5000)
+    parser.add_argument('--days', type = int, default = 750)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+    PATH = generate(args.root, args.stocks, args.days, args.seed)
+    print(f'Successfully generate {args.stocks} stocks x {args.days} days in {args.root}, PATH = {PATH}')
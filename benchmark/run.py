@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg') # 基准测试不需要图形界面
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tracemalloc
+import subprocess
+from typing import Callable, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mysystem import dataset, profiler, utils
+from mysystem.backtest import Backtest
+from mysystem.alphapool import AlphaPool
+from generate import generate
+
+
+def measure(func: Callable, setup: Optional[Callable] = None, repeat: int = 3) -> dict:
+    '''
+    测量func的运行时间和内存峰值: 运行repeat次取最短时间, 再在tracemalloc下运行一次记录内存峰值 \n
+    setup: 每次运行前调用, 不计入时间, 例如删除已创建的dataset
+    '''
+    seconds = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(seconds), 'seconds_all': seconds, 'peak_mb': peak / 2 ** 20}
+
+
+def run_size(ROOT: str, n_stocks: int, n_days: int, repeat: int) -> list:
+    '''
+    在一个数据规模上运行所有基准测试, 返回每个测试一条记录的列表
+    '''
+    if os.path.exists(ROOT):
+        shutil.rmtree(ROOT)
+    t = time.perf_counter()
+    PATH = generate(ROOT, n_stocks, n_days)
+    print(f'Generate {n_stocks} stocks x {n_days} days in {time.perf_counter() - t:.1f}s')
+    STORE_FOLDER = os.path.join(PATH, '../dataset/')
+    records = []
+
+    def record(stage: str, func: Callable, setup: Optional[Callable] = None) -> None:
+        res = measure(func, setup, repeat)
+        res.update({'stage': stage, 'n_stocks': n_stocks, 'n_days': n_days})
+        records.append(res)
+        print(f"{stage:24s} {res['seconds']:9.4f}s {res['peak_mb']:10.1f} MB")
+
+    def clear_dataset() -> None:
+        shutil.rmtree(STORE_FOLDER, ignore_errors = True)
+        dataset._REGISTRY.clear()
+
+    # 读取数据: 从原始数据创建dataset, 以及读取已创建的dataset(清空进程内的共享数据集)
+    record('get_data_build', lambda: dataset.get_data(PATH), clear_dataset)
+    record('get_data_load', lambda: dataset.get_data(PATH)['close'].values.sum(), dataset._REGISTRY.clear)
+    data = dataset.get_data(PATH)
+
+    # 回测中的各个步骤
+    start, end = str(data.index[0].date()).replace('-', ''), str(data.index[-1].date()).replace('-', '')
+    bt = Backtest(PATH, start, end, cache_size = 0, batch = True)
+    alpha = (-data['ret'].rolling(5).sum()).shift(1)
+    weight = bt.get_weight(alpha)
+    pnl = bt.get_pnl(weight, bt.init_cap)
+    record('Backtest.get_ic', lambda: bt.get_ic(alpha))
+    record('Backtest.get_weight', lambda: bt.get_weight(alpha))
+    record('Backtest.get_pnl', lambda: bt.get_pnl(weight, bt.init_cap))
+    record('Backtest.max_drawdown', lambda: bt.max_drawdown(pnl))
+    record('Backtest.backtest', lambda: bt.backtest(alpha, 'bench', output = ['metrics']))
+
+    # 因子工具
+    other = np.log(data['volume']).shift(1)
+    record('utils.corr', lambda: utils.corr(alpha, other))
+    record('utils.cleanOutlier', lambda: utils.cleanOutlier(alpha))
+
+    # 因子池: 先加入5个因子, 再评估一个新因子
+    ap = AlphaPool(PATH, start, end, batch = True)
+    for d in (1, 3, 10, 20, 60):
+        ap.add(data['ret'].rolling(d).sum(), f'ret{d}')
+    new_alpha = data['ret'].rolling(5).std()
+    clear_cache = lambda: shutil.rmtree(os.path.join(PATH, '../cache/'), ignore_errors = True) # 不使用缓存的回测结果
+    record('AlphaPool.eval', lambda: ap.eval(new_alpha, 'std5'), clear_cache)
+    bt.flush()
+    ap.backtest.flush()
+    return records
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__)), check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'time the main steps of the system on synthetic data')
+    parser.add_argument('--sizes', nargs = '+', default = ['1000x750', '5000x750'],
+                        help = 'data sizes as STOCKSxDAYS, e.g. 1000x750 5000x750 10000x2500')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'runs per step, the fastest one is reported')
+    parser.add_argument('--workdir', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'work'),
+                        help = 'folder for the generated data, removed and recreated for each size')
+    parser.add_argument('--output', default = None, help = 'json file for the results, default results/<time>.json')
+    parser.add_argument('--trace', default = None, help = 'record the stages of each step and export them to this trace file')
+    args = parser.parse_args()
+    if args.trace is not None:
+        profiler.enable(memory = False) # 内存峰值由measure记录
+
+    results = []
+    for size in args.sizes:
+        n_stocks, n_days = map(int, size.lower().split('x'))
+        print(f'Start benchmarking {n_stocks} stocks x {n_days} days')
+        results += run_size(os.path.join(args.workdir, size), n_stocks, n_days, args.repeat)
+
+    now = time.strftime('%Y%m%d_%H%M%S')
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', f'{now}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok = True)
+    meta = {'time': now, 'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__, 'repeat': args.repeat}
+    with open(output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent = 2)
+    print(f'Successfully write benchmark results to {output}')
+    if args.trace is not None:
+        profiler.export(args.trace)
+        print(f'Successfully write stage trace to {args.trace}')
@@ -6,13 +6,17 @@ from IPython.display import display # 展示pd.DataFrame的函数
 
 import os
 from typing import Optional
-from .utils import corr
+from .utils import cs_corr, cs_zscore
 from .backtest import Backtest
+from .universe import Universe, take
+from . import profiler
 
 # 设置plt负号和中文显示
 plt.rcParams['font.sans-serif'] = ['SimHei']
 plt.rcParams['axes.unicode_minus'] = False
 
+INDEX_COLUMNS = ['alpha_name', 'start', 'end', 'pool'] # 因子池索引文件中回测指标之前的列
+
 
 class AlphaPool:
     '''
@@ -22,89 +26,206 @@ class AlphaPool:
     end: 因子池结束的时间, 例如'20221231' \n
     pool: 资产池, 目前支持的可选项有'all'(沪深全市场), 'hs300'(沪深300成分股, 实时跟踪),
     也可直接传入一个one-hot的pd.DataFrame \n
-    output: 因子回测的输出, 可选项包括ic, pnl, weight, metrics
+    output: 因子回测的输出, 可选项包括ic, pnl, weight, metrics \n
+    batch: 批量模式, 设置为True时不绘图也不展示回测指标
     '''
     def __init__(self, PATH: str, start: str, end: str, pool = 'all', 
-                 output: list = ['ic', 'pnl', 'metrics']) -> None:
+                 output: list = ['ic', 'pnl', 'metrics'], batch: bool = False) -> None:
         self.STORE_PATH = os.path.join(PATH, '../alpha/') # 储存因子的路径
+        self.INDEX_PATH = os.path.join(self.STORE_PATH, 'alpha_index.csv') # 因子池索引文件的路径
         self.start = start
         self.end = end
-        self.pool_name, self.pool = self.get_pool(pool)
         self.output = output
+        self.batch = batch
         self.alpha_list = {}
-        self.backtest = Backtest(PATH = PATH, start = start, end = end, 
-                                 pool = pool, output = output) # 用于回测因子池中因子的回测类
-
-    def get_pool(self, pool) -> Optional[pd.DataFrame]:
-        '''
-        获取股票池的DataFrame
-        '''
-        # 检查pool输入格式
-        assert isinstance(pool, (str, pd.DataFrame)), 'pool should be str type or pd.DataFrame'
-        if isinstance(pool, str):
-            # 沪深全股票
-            if pool == 'all':
-                return 'all', None
-            # 沪深300
-            elif pool == 'hs300':
-                pool = pd.read_csv(os.path.join(self.PATH, 'newdata/hs300.csv'), index_col = 0)
-                pool.index = pd.to_datetime(pool.index)
-                return 'hs300', pool
-            # 不支持的字符串, 默认为all
-            else:
-                print(f"unsupported pool {pool}, setting pool to 'all'")
-                return 'all', None
-        
-        else: # 自定义股票池, 需保证日期和股票名均在可回测范围内
-            assert pool.index.isin(self.ret.index).all(), 'invalid date'
-            assert pool.columns.isin(self.ret.columns).all(), 'invalid stock name'
-            return pool.index.name, pool
+        self.backtest = Backtest(PATH = PATH, start = start, end = end, pool = pool, 
+                                 output = output, batch = batch) # 用于回测因子池中因子的回测类
+        self.pool_name, self.pool = self.backtest.pool_name, self.backtest.pool # 资产池名称和成分股索引
+        # 因子池中因子两两之间截面相关系数均值的缓存, 储存在因子池路径下
+        self.CORR_PATH = os.path.join(self.STORE_PATH, f'corr_{start}_{end}_{self.pool_name}.csv')
+        if os.path.exists(self.CORR_PATH):
+            self.corr_matrix = pd.read_csv(self.CORR_PATH, index_col = 0)
+        else:
+            self.corr_matrix = pd.DataFrame(dtype = float)
 
-    def add_from_path(self) -> None:
+    def get_pool(self, pool) -> (str, Optional[Universe]):
+        '''
+        获取股票池的成分股索引, 与回测类的资产池一致
+        '''
+        return self.backtest.get_pool(pool)
+
+    def read_index(self) -> pd.DataFrame:
         '''
-        从因子池路径调取已经存在的因子
+        读取因子池的索引文件, 每行为一个因子在一个回测区间和资产池上的记录, 包括因子名称, 回测区间, 资产池和回测指标
         '''
-        for alpha_name in os.listdir(self.STORE_PATH): # 找到所有因子
+        if os.path.exists(self.INDEX_PATH):
+            return pd.read_csv(self.INDEX_PATH, dtype = {'alpha_name': str, 'start': str, 'end': str, 'pool': str})
+        return pd.DataFrame(columns = INDEX_COLUMNS)
+
+    def update_index(self, alpha_name: str, metrics: pd.DataFrame, start: Optional[str] = None, 
+                     end: Optional[str] = None, pool_name: Optional[str] = None) -> None:
+        '''
+        在因子池的索引文件中写入(或覆盖)因子在回测区间和资产池上的记录, start, end, pool_name默认为因子池的参数
+        '''
+        start = self.start if start is None else start
+        end = self.end if end is None else end
+        pool_name = self.pool_name if pool_name is None else pool_name
+        index = self.read_index()
+        index = index[~((index['alpha_name'] == alpha_name) & (index['start'] == start) & 
+                        (index['end'] == end) & (index['pool'] == pool_name))]
+        record = pd.DataFrame([[alpha_name, start, end, pool_name]], columns = INDEX_COLUMNS)
+        record = pd.concat([record, metrics.reset_index(drop = True)], axis = 1)
+        index = record if len(index) == 0 else pd.concat([index, record], axis = 0, ignore_index = True)
+        index.to_csv(self.INDEX_PATH, index = False)
+
+    def store_alpha(self, alpha: pd.DataFrame, alpha_name: str, name: Optional[str] = None) -> None:
+        '''
+        将因子值储存为二进制的.npy文件, 日期和股票代码储存在同名的_axes.npz文件中 \n
+        先写入临时文件再替换, 其他因子池或get_alpha内存映射的旧文件不受影响 \n
+        name: 文件名前缀, 默认为'{因子名称}_{start}_{end}_{资产池}', 使用因子池的参数
+        '''
+        ALPHA_PATH = os.path.join(self.STORE_PATH, alpha_name)
+        if name is None:
+            name = f'{alpha_name}_{self.start}_{self.end}_{self.pool_name}'
+        VALUES_PATH = os.path.join(ALPHA_PATH, f'{name}_alpha.npy')
+        AXES_PATH = os.path.join(ALPHA_PATH, f'{name}_axes.npz')
+        np.save(VALUES_PATH + '.tmp.npy', np.ascontiguousarray(alpha.values, dtype = np.float64))
+        np.savez(AXES_PATH + '.tmp.npz', date = np.asarray(alpha.index.values, dtype = 'datetime64[ns]'), 
+                 id = np.asarray(alpha.columns).astype(str))
+        os.replace(VALUES_PATH + '.tmp.npy', VALUES_PATH)
+        os.replace(AXES_PATH + '.tmp.npz', AXES_PATH)
+
+    def get_alpha(self, alpha_name: str) -> pd.DataFrame:
+        '''
+        获取因子池中因子的因子值, 首次访问时以内存映射的方式读取
+        '''
+        pooled_alpha = self.alpha_list[alpha_name]
+        if pooled_alpha['alpha'] is None:
+            name = f'{alpha_name}_{self.start}_{self.end}_{self.pool_name}'
+            values = np.load(os.path.join(pooled_alpha['path'], f'{name}_alpha.npy'), mmap_mode = 'r')
+            axes = np.load(os.path.join(pooled_alpha['path'], f'{name}_axes.npz'))
+            pooled_alpha['alpha'] = pd.DataFrame(values, index = pd.DatetimeIndex(axes['date'], name = 'date'), 
+                                                 columns = pd.Index(axes['id'], dtype = object), copy = False)
+        return pooled_alpha['alpha']
+
+    def convert_csv(self) -> None:
+        '''
+        将旧版本以.csv储存的因子转换为二进制格式, 并写入索引文件: 转换因子池路径下所有尚未转换的
+        {因子名称}_{start}_{end}_{资产池}_alpha.csv, 回测区间和资产池由文件名得到, 不限于当前因子池的参数
+        '''
+        for alpha_name in os.listdir(self.STORE_PATH):
             ALPHA_PATH = os.path.join(self.STORE_PATH, alpha_name)
+            if not os.path.isdir(ALPHA_PATH):
+                continue
+            for file_name in sorted(os.listdir(ALPHA_PATH)):
+                if not (file_name.startswith(f'{alpha_name}_') and file_name.endswith('_alpha.csv')):
+                    continue
+                name = file_name[: -len('_alpha.csv')]
+                window = name[len(alpha_name) + 1:].split('_', 2) # 回测区间和资产池
+                if len(window) != 3 or os.path.exists(os.path.join(ALPHA_PATH, f'{name}_alpha.npy')): # 已经转换
+                    continue
+                start, end, pool_name = window
+                assert os.path.exists(os.path.join(ALPHA_PATH, f'{name}_metrics.csv')), \
+                    f"missing file: metrics of alpha ({name}) in alphapool" # 检查因子回测文件存在
+                alpha = pd.read_csv(os.path.join(ALPHA_PATH, f'{name}_alpha.csv'), index_col = 0) # 因子值
+                alpha.index = pd.to_datetime(alpha.index)
+                metrics = pd.read_csv(os.path.join(ALPHA_PATH, f'{name}_metrics.csv'), index_col = 0).T # 因子回测指标
+                self.store_alpha(alpha, alpha_name, name)
+                self.update_index(alpha_name, metrics, start, end, pool_name)
+                print(f'Successfully convert alpha {name} to binary format')
+
+    def add_from_path(self) -> None:
+        '''
+        从因子池路径调取已经存在的因子: 只读取索引文件中的回测指标, 因子值在首次使用时读取
+        '''
+        if os.path.exists(self.STORE_PATH): # 先转换旧版本以.csv储存的因子
+            self.convert_csv()
+        index = self.read_index()
+        index = index[(index['start'] == self.start) & (index['end'] == self.end) & (index['pool'] == self.pool_name)]
+        for _, record in index.iterrows():
+            alpha_name = record['alpha_name']
             # 若因子不在因子池中, 则加入
             if alpha_name not in self.alpha_list.keys():
-                name = f'{alpha_name}_{self.start}_{self.end}_{self.pool_name}'
-                if os.path.exists(os.path.join(ALPHA_PATH, f'{name}_alpha.csv')):
-                    assert os.path.exists(os.path.join(ALPHA_PATH, f'{name}_metrics.csv')), \
-                        f"missing file: metrics of alpha ({name}) in alphapool" # 检查因子回测文件存在
-                    alpha = pd.read_csv(os.path.join(ALPHA_PATH, f'{name}_alpha.csv'), index_col = 0) # 因子值
-                    metrics = pd.read_csv(os.path.join(ALPHA_PATH, f'{name}_metrics.csv'), index_col = 0).T # 因子回测指标
-                    self.alpha_list[alpha_name] = {'alpha': alpha, 'metrics': metrics, 'path': ALPHA_PATH}
+                metrics = record.drop(INDEX_COLUMNS).astype(float).to_frame(alpha_name).T # 因子回测指标
+                self.alpha_list[alpha_name] = {'alpha': None, 'metrics': metrics, 
+                                               'path': os.path.join(self.STORE_PATH, alpha_name)}
+        self.update_corr() # 补全相关系数缓存中缺失的因子对
         print(f'Successfully add alphas from {self.STORE_PATH}')
 
+    def corr_with(self, alpha: pd.DataFrame, alpha_names: list, batch_size: int = 8) -> pd.Series:
+        '''
+        批量计算alpha与因子池中因子在每个截面上相关系数的均值 \n
+        alpha: 回测期间内的因子值 \n
+        alpha_names: 因子池中需要计算相关系数的因子名称 \n
+        batch_size: 每批同时计算的因子个数
+        '''
+        res = pd.Series(index = alpha_names, dtype = float)
+        for i in range(0, len(alpha_names), batch_size):
+            names = alpha_names[i: i + batch_size]
+            pooled = np.stack([self.get_alpha(name).reindex(index = alpha.index, columns = alpha.columns).values 
+                               for name in names])
+            res[names] = pd.DataFrame(cs_corr(pooled, alpha.values).T).mean(axis = 0).values
+        return res
+
+    def update_corr(self, alpha_names: Optional[list] = None) -> None:
+        '''
+        更新因子池的相关系数矩阵, 只计算缓存中缺失的因子对, 并储存到因子池路径下 \n
+        alpha_names: 需要更新的因子名称, 为None时检查因子池中所有因子
+        '''
+        pooled_names = list(self.alpha_list.keys())
+        if alpha_names is None:
+            alpha_names = pooled_names
+        matrix = self.corr_matrix.reindex(index = pooled_names, columns = pooled_names)
+        updated = False
+        for alpha_name in alpha_names:
+            matrix.loc[alpha_name, alpha_name] = 1.0
+            missing = [name for name in pooled_names if np.isnan(matrix.loc[alpha_name, name])]
+            if len(missing) > 0:
+                corr = self.corr_with(self.get_alpha(alpha_name), missing)
+                matrix.loc[alpha_name, missing] = corr.values
+                matrix.loc[missing, alpha_name] = corr.values
+                updated = True
+
+        # 合并缓存中不在当前因子池的因子, 并储存
+        others = self.corr_matrix.index.difference(pooled_names)
+        self.corr_matrix = matrix.combine_first(self.corr_matrix.loc[others, others])
+        if updated:
+            if not os.path.exists(self.STORE_PATH):
+                os.mkdir(self.STORE_PATH)
+            self.corr_matrix.to_csv(self.CORR_PATH)
+
     def add(self, alpha: pd.DataFrame, alpha_name: str) -> None:
         '''
         向因子池加入因子
         alpha: 需要加入的因子
         alpha_name: 因子名称
         '''
-        # 检查, 创建储存因子的路径
-        if not os.path.exists(self.STORE_PATH):
-            os.mkdir(self.STORE_PATH)
-        ALPHA_PATH = os.path.join(self.STORE_PATH, alpha_name)
-        if not os.path.exists(ALPHA_PATH):
-            os.mkdir(ALPHA_PATH)
+        with profiler.stage('alphapool.add', *alpha.shape):
+            # 检查, 创建储存因子的路径
+            if not os.path.exists(self.STORE_PATH):
+                os.mkdir(self.STORE_PATH)
+            ALPHA_PATH = os.path.join(self.STORE_PATH, alpha_name)
+            if not os.path.exists(ALPHA_PATH):
+                os.mkdir(ALPHA_PATH)
 
-        if self.pool is not None:
-            alpha = alpha[self.pool == 1] # 资产池内股票的因子值
-        alpha = alpha.shift(1)[self.start: self.end] # 回测期间内股票的因子值
-        name = f'{alpha_name}_{self.start}_{self.end}_{self.pool_name}'
+            with profiler.stage('alphapool.mask', *alpha.shape):
+                if self.pool is not None:
+                    alpha = self.pool.where(alpha) # 资产池内股票的因子值
+                alpha = alpha.shift(1)[self.start: self.end] # 回测期间内股票的因子值
 
-        # 计算alpha的回测指标
-        if not os.path.exists(os.path.join(ALPHA_PATH, f'{name}_metrics.csv')):
-            self.backtest.backtest(alpha, alpha_name, output = ['metrics'])
-        
-        metrics = pd.read_csv(os.path.join(ALPHA_PATH, f'{name}_metrics.csv'), index_col = 0).T
+            # 计算alpha的回测指标, 因子值和回测参数未改变时直接使用缓存的回测结果
+            metrics = self.backtest.backtest(alpha, alpha_name, output = ['metrics'])['metrics'].T
 
-        self.alpha_list[alpha_name] = {'alpha': alpha, 'metrics': metrics, 'path': ALPHA_PATH}
-        # 储存alpha
-        alpha.to_csv(os.path.join(ALPHA_PATH, f'{name}_alpha.csv'))
-        print(f'Successfully add alpha {alpha_name} to {ALPHA_PATH}')
+            self.alpha_list[alpha_name] = {'alpha': alpha, 'metrics': metrics, 'path': ALPHA_PATH}
+            # 重新计算新因子与因子池中因子的相关系数
+            with profiler.stage('alphapool.corr', *alpha.shape):
+                self.corr_matrix = self.corr_matrix.drop(index = alpha_name, columns = alpha_name, errors = 'ignore')
+                self.update_corr([alpha_name])
+            # 储存alpha, 并写入索引文件
+            with profiler.stage('alphapool.store', *alpha.shape):
+                self.store_alpha(alpha, alpha_name)
+                self.update_index(alpha_name, metrics)
+            print(f'Successfully add alpha {alpha_name} to {ALPHA_PATH}')
         
 
     def eval(self, alpha: pd.DataFrame, alpha_name: str, sort_index: Optional[str] = None) -> None:
@@ -115,43 +236,161 @@ class AlphaPool:
         sort_index: 回测指标排序方式,可选项有IC均值, ICIR, rankIC均值, rankICIR, 年化收益率, 年化波动率, 
         夏普比率, 最大回撤, 胜率, 相关系数, 若为None则不排序
         '''
-        # 检查, 创建储存因子的路径
-        if not os.path.exists(self.STORE_PATH):
-            os.mkdir(self.STORE_PATH)
-        ALPHA_PATH = os.path.join(self.STORE_PATH, alpha_name)
-        if not os.path.exists(ALPHA_PATH):
-            os.mkdir(ALPHA_PATH)
-
-        if self.pool is not None:
-            alpha = alpha[self.pool == 1] # 资产池内股票的因子值
-        alpha = alpha.shift(1)[self.start: self.end] # 回测期间内股票的因子值
-        name = f'{alpha_name}_{self.start}_{self.end}_{self.pool_name}'    
-        # 计算alpha的指标
-        if not os.path.exists(os.path.join(ALPHA_PATH, f'{name}_metrics.csv')):
-            self.backtest.backtest(alpha, alpha_name, output = ['metrics'])
-
-        # 读取回测指标
-        metrics = pd.read_csv(os.path.join(ALPHA_PATH, f'{name}_metrics.csv'), index_col = 0).T
-        metrics['相关系数'] = 1.0
-        metrics_list = [metrics]
-
-        # 计算因子相关性
-        for pooled_alpha in self.alpha_list.values(): 
-            metrics = pooled_alpha['metrics']
-            metrics['相关系数'] = corr(alpha, pooled_alpha['alpha'])
-            metrics_list.append(metrics)
-
-        # 对比alpha与因子池内因子的指标
-        metrics_list = pd.concat(metrics_list, axis = 0)
-        if sort_index is not None:
-            assert sort_index in metrics_list.columns, f'sort index should be in {metrics_list.columns}'
-        display(metrics_list)
-
-        # 绘制相关系数热力图
-        plt.figure(figsize = (len(metrics_list), 1))
-        ax = sns.heatmap(metrics_list[['相关系数']].rename(columns = {'相关系数': alpha_name}).T, 
-                         cmap="YlGnBu", annot=True, linewidths=.5)
-        plt.yticks(rotation = 0)
-        plt.show()
+        with profiler.stage('alphapool.eval', *alpha.shape):
+            # 检查, 创建储存因子的路径
+            if not os.path.exists(self.STORE_PATH):
+                os.mkdir(self.STORE_PATH)
+            ALPHA_PATH = os.path.join(self.STORE_PATH, alpha_name)
+            if not os.path.exists(ALPHA_PATH):
+                os.mkdir(ALPHA_PATH)
+
+            with profiler.stage('alphapool.mask', *alpha.shape):
+                if self.pool is not None:
+                    alpha = self.pool.where(alpha) # 资产池内股票的因子值
+                alpha = alpha.shift(1)[self.start: self.end] # 回测期间内股票的因子值
+            # 计算alpha的指标, 因子值和回测参数未改变时直接使用缓存的回测结果
+            metrics = self.backtest.backtest(alpha, alpha_name, output = ['metrics'])['metrics'].T
+            metrics['相关系数'] = 1.0
+            metrics_list = [metrics]
+
+            # 批量计算因子相关性
+            with profiler.stage('alphapool.corr', *alpha.shape):
+                corr = self.corr_with(alpha, list(self.alpha_list.keys()))
+            for pooled_name, pooled_alpha in self.alpha_list.items(): 
+                metrics = pooled_alpha['metrics']
+                metrics['相关系数'] = corr[pooled_name]
+                metrics_list.append(metrics)
+
+            # 对比alpha与因子池内因子的指标
+            metrics_list = pd.concat(metrics_list, axis = 0)
+            if sort_index is not None:
+                assert sort_index in metrics_list.columns, f'sort index should be in {metrics_list.columns}'
+            if self.batch:
+                return
+            with profiler.stage('alphapool.display', len(metrics_list)):
+                display(metrics_list)
+
+            # 绘制相关系数热力图, 展示后关闭
+            with profiler.stage('alphapool.plot', len(metrics_list)):
+                plt.figure(figsize = (len(metrics_list), 1))
+                ax = sns.heatmap(metrics_list[['相关系数']].rename(columns = {'相关系数': alpha_name}).T, 
+                                 cmap="YlGnBu", annot=True, linewidths=.5)
+                plt.yticks(rotation = 0)
+                plt.show()
+                plt.close()
         
     
+
+    def stack(self, alpha_names: Optional[list] = None) -> (pd.DatetimeIndex, pd.Index, np.ndarray):
+        '''
+        将因子池中的因子堆叠为一个连续的三维数组, 以第一个因子的日期和股票代码对齐 \n
+        alpha_names: 需要堆叠的因子名称, 为None时使用因子池中所有因子 \n
+        返回日期index, 股票代码columns和shape = (K, T, N)的因子值
+        '''
+        if alpha_names is None:
+            alpha_names = list(self.alpha_list.keys())
+        assert len(alpha_names) > 0, 'no alpha to stack'
+        first = self.get_alpha(alpha_names[0])
+        index, columns = first.index, first.columns
+        values = np.empty((len(alpha_names), len(index), len(columns)))
+        for k, alpha_name in enumerate(alpha_names):
+            alpha = self.get_alpha(alpha_name)
+            if not (alpha.index.equals(index) and alpha.columns.equals(columns)):
+                alpha = alpha.reindex(index = index, columns = columns)
+            values[k] = alpha.values
+        return index, columns, values
+
+    def factor_returns(self, index: pd.Index, columns: pd.Index, values: np.ndarray, ridge: Optional[float] = None, 
+                       chunk_size: Optional[int] = None) -> (np.ndarray, Optional[np.ndarray]):
+        '''
+        按回测的对齐方式(每天使用前一天的因子值和资产池成分股)计算每个因子每日的IC, 
+        以及所有因子对次日收益率的截面岭回归系数 \n
+        index, columns, values: stack返回的日期, 股票代码和shape = (K, T, N)的因子值(需已截面标准化) \n
+        ridge: 岭回归的惩罚系数, 相对于因子的截面相关系数矩阵, 为None时不做回归 \n
+        chunk_size: 每次计算的日期数, 为None时按因子个数和股票个数自动选择, 每块约2 ** 20个因子值,
+        较小的块可以避免大量因子时的临时数组占用过多内存 \n
+        返回shape = (T, K)的IC和回归系数(未计算时为None), 与回测中各日期的IC对齐, 第一天为NaN
+        '''
+        K = len(values)
+        window, rows, cols, ret_rows, ret_cols = self.backtest.align(index, columns, index[0], index[-1], self.pool)
+        ic = np.full((len(window), K), np.nan)
+        coef = np.full((len(window), K), np.nan) if ridge is not None else None
+        width = len(columns) if cols is None else cols.shape[1] # 每日参与计算的股票个数
+        step = chunk_size if chunk_size is not None else max(2 ** 20 // (K * max(width, 1)), 1)
+        for s in range(0, len(window), step):
+            chunk_cols = cols if cols is None else cols[s: s + step]
+            X = np.stack([take(values[k], rows[s: s + step], chunk_cols) for k in range(K)]) # (K, c, M)
+            y = self.backtest.take_ret(ret_rows[s: s + step], 
+                                       ret_cols if ret_cols is None or ret_cols.ndim == 1 else ret_cols[s: s + step]) # (c, M)
+            ic[s: s + step] = cs_corr(X, y).T
+            if ridge is None:
+                continue
+
+            # 截面岭回归: 缺失的因子值取截面均值0, 收益率缺失的股票不参与回归, 所有日期的正规方程批量求解
+            valid = ~np.isnan(y)
+            n = valid.sum(axis = 1)
+            scale = np.maximum(n, 1)[:, None, None]
+            y = np.where(valid, y, 0)
+            y = np.where(valid, y - y.sum(axis = 1, keepdims = True) / scale[:, 0], 0) # 截面去均值
+            X = np.where(valid & ~np.isnan(X), X, 0).transpose(1, 0, 2) # (c, K, M)
+            XtX = X @ X.transpose(0, 2, 1) / scale + ridge * np.eye(K)
+            Xty = X @ y[:, :, None] / scale
+            res = np.linalg.solve(XtX, Xty)[:, :, 0]
+            res[n < 2] = np.nan
+            coef[s: s + step] = res
+        return ic, coef
+
+    def combine(self, alpha_names: Optional[list] = None, method: str = 'ic', lookback: int = 20, 
+                ridge: float = 0.1, alpha_name: str = 'combined', output: Optional[list] = None, 
+                chunk_size: Optional[int] = None) -> dict:
+        '''
+        合成因子池中的因子并回测: 各因子先做截面标准化, 再按每日的权重加权求和, 合成因子直接传入回测, 不写入中间文件 \n
+        alpha_names: 参与合成的因子名称, 为None时使用因子池中所有因子 \n
+        method: 权重计算方法, 可选'equal'(等权, 因子方向需一致), 'ic'(过去lookback天IC均值加权),
+        'ridge'(过去lookback天截面岭回归系数的均值加权) \n
+        lookback: 计算IC或回归系数均值的回看天数, 有效天数不足一半的因子当天权重为NaN(不参与合成) \n
+        ridge: 岭回归的惩罚系数 \n
+        alpha_name: 合成因子的名称, 回测结果储存在因子池路径下的同名文件夹中 \n
+        output: 回测输出, 为None时与因子池一致 \n
+        chunk_size: 计算IC和回归系数时每次计算的日期数, 为None时自动选择 \n
+        每天的权重只使用在当天因子值之前已经实现的IC和回归系数(回测中IC对应的次日收益率在两天后才实现),
+        并按绝对值之和归一化 \n
+        返回{'alpha': 合成因子, 'weight': 每日各因子的权重, 'ic': IC, 'pnl': PnL, 'metrics': 回测指标}
+        '''
+        assert method in ['equal', 'ic', 'ridge'], "method should be 'equal', 'ic' or 'ridge'"
+        assert method != 'ridge' or ridge > 0, 'ridge should be positive'
+        with profiler.stage('alphapool.combine') as stage:
+            if alpha_names is None:
+                alpha_names = list(self.alpha_list.keys())
+            with profiler.stage('alphapool.stack'):
+                index, columns, values = self.stack(alpha_names)
+                for k in range(len(values)): # 截面标准化, 使各因子的量纲一致
+                    values[k] = cs_zscore(values[k])
+            K, T, N = values.shape
+            stage.rows, stage.cols = T, N
+
+            # 每日各因子的权重, shape = (T, K)
+            if method == 'equal':
+                weight = np.full((T, K), 1 / K)
+            else:
+                with profiler.stage(f'alphapool.{method}', T, N):
+                    ic, coef = self.factor_returns(index, columns, values, ridge if method == 'ridge' else None, chunk_size)
+                    score = pd.DataFrame(ic if method == 'ic' else coef)
+                    score = score.rolling(lookback, min_periods = max(lookback // 2, 1)).mean().shift(2).values
+                    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                        weight = score / np.nansum(np.abs(score), axis = 1, keepdims = True)
+
+            # 合成因子: 缺失的因子值按截面均值0处理, 所有因子均缺失的位置为NaN
+            with profiler.stage('alphapool.composite', T, N):
+                missing = np.isnan(values).all(axis = 0)
+                np.nan_to_num(values, copy = False, nan = 0)
+                combined = np.einsum('tk,ktn->tn', np.nan_to_num(weight, nan = 0), values)
+                combined[missing | np.isnan(weight).all(axis = 1, keepdims = True)] = np.nan
+            del values
+            combined = pd.DataFrame(combined, index = index, columns = columns)
+            weight = pd.DataFrame(weight, index = index, columns = alpha_names)
+
+            # 回测合成因子, 与因子池中因子的回测方式一致
+            res = self.backtest.backtest(combined, alpha_name, output = output)
+            res.update({'alpha': combined, 'weight': weight})
+        return res
@@ -4,14 +4,149 @@ import matplotlib.pyplot as plt
 from IPython.display import display # 展示pd.DataFrame的函数
 
 import os
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from typing import Optional
 from .dataset import get_data
+from . import profiler
+from .utils import cs_corr, cs_rank
+from .cache import ResultCache
+from .universe import Universe, load_universe, take
+from .writer import ArtifactWriter
 
 # 设置plt负号和中文显示
 plt.rcParams['font.sans-serif'] = ['SimHei']
 plt.rcParams['axes.unicode_minus'] = False
 
 
+def portfolio_values(alpha: np.ndarray, ret: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    '''
+    计算一段日期上的IC, 权重和组合收益率, 各日期之间相互独立, 可以按日期分块计算 \n
+    alpha: shape = (T, N)的因子值(已经过资产池筛选, 平移和截取回测区间), N可以只包含每日的成分股 \n
+    ret: shape = (T, N)的收益率, 与alpha对齐 \n
+    返回shape = (T, 2)的IC, rankIC, shape = (T,)的当日权重对应的次日组合收益率和shape = (T, N)的权重,
+    权重和组合收益率对应因子的原始方向, 因子方向需要反转时二者同时取相反数
+    '''
+    ic = np.stack([cs_corr(alpha, ret), cs_corr(alpha, ret, method = 'spearman')], axis = 1)
+
+    # 计算权重, 每个截面上权重绝对值之和为1
+    abssum = np.nansum(np.abs(alpha), axis = 1, keepdims = True)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        weight = np.where(abssum > 1e-8, alpha / abssum, 0)
+    weight = np.nan_to_num(weight, nan = 0)
+    return ic, np.nansum(weight * ret, axis = 1), weight
+
+
+def pnl_values(ic: np.ndarray, day_ret: np.ndarray, init_cap: float) -> (int, np.ndarray):
+    '''
+    由整个回测区间的IC和组合收益率确定因子方向(IC均值小于0时反转因子)并计算PnL, 返回因子方向和PnL
+    '''
+    sign = -1 if pd.Series(ic[:, 0]).mean() < 0 else 1
+    portfolio_ret = np.zeros(len(day_ret))
+    portfolio_ret[1:] = sign * day_ret[:-1] # 当日权重对应次日的组合收益率
+    pnl = init_cap * (1 + portfolio_ret.cumsum())
+    return sign, pnl
+
+
+def backtest_values(alpha: np.ndarray, ret: np.ndarray, init_cap: float, return_weight: bool = False) -> tuple:
+    '''
+    在已对齐的np.ndarray上完成回测的计算部分: IC, 权重和PnL \n
+    alpha: shape = (T, N)的因子值(已经过资产池筛选, 平移和截取回测区间), N可以只包含每日的成分股 \n
+    ret: shape = (T, N)的收益率, 与alpha对齐 \n
+    return_weight: 是否同时返回权重 \n
+    返回shape = (T, 2)的IC, rankIC和shape = (T,)的PnL, return_weight为True时还返回shape = (T, N)的权重
+    '''
+    ic, day_ret, weight = portfolio_values(alpha, ret)
+    sign, pnl = pnl_values(ic, day_ret, init_cap)
+    if return_weight:
+        return ic, pnl, sign * weight
+    return ic, pnl
+
+
+def analyze_values(alpha: np.ndarray, ret: np.ndarray, cols: Optional[np.ndarray] = None, 
+                   n_groups: int = 10, cost_rate: float = 0.0) -> dict:
+    '''
+    在已对齐的np.ndarray上一次性计算分层回测和换手率等分析结果, 所有结果均为每个日期一行 \n
+    alpha, ret: 与backtest_values相同 \n
+    cols: alpha每个位置对应的股票所在列(由Backtest.align得到), 资产池不为全市场时用于对齐相邻两天的权重, None表示所有列 \n
+    n_groups: 分层的组数, 按调整方向后的因子值从小到大分为n_groups组, 最后一组为多头方向 \n
+    cost_rate: 单边交易费率, 每日扣除cost_rate * 换手率 \n
+    返回{'ic': IC, 'group': shape = (T, n_groups)的各组等权收益率, 'long': 多头收益率, 'short': 空头收益率, 
+    'turnover': 换手率, 'portfolio_ret': 组合收益率, 'net_ret': 扣除交易费用后的组合收益率}, 
+    收益率均为当日权重对应的次日收益率
+    '''
+    ic, day_ret, weight = portfolio_values(alpha, ret)
+    sign = -1 if pd.Series(ic[:, 0]).mean() < 0 else 1
+    weight, day_ret = sign * weight, sign * day_ret
+    T, N = alpha.shape
+
+    # 分层: 每个截面上按因子值的排名分组, 用bincount一次性计算所有日期各组的平均收益率
+    valid = ~np.isnan(alpha) & ~np.isnan(ret)
+    rank = cs_rank(sign * alpha, mask = valid)
+    count = valid.sum(axis = 1, keepdims = True)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        group = np.floor((rank - 1) * n_groups / count)
+    key = (np.arange(T)[:, None] * n_groups + group)[valid].astype(np.int64)
+    group_sum = np.bincount(key, weights = ret[valid], minlength = T * n_groups).reshape(T, n_groups)
+    group_count = np.bincount(key, minlength = T * n_groups).reshape(T, n_groups)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        group_ret = np.where(group_count > 0, group_sum / group_count, np.nan)
+
+    # 多头和空头收益率
+    weighted_ret = weight * ret
+    long_ret = np.nansum(np.where(weight > 0, weighted_ret, 0), axis = 1)
+    short_ret = np.nansum(np.where(weight < 0, weighted_ret, 0), axis = 1)
+
+    # 换手率: 相邻两天权重之差的绝对值之和, 第一天为建仓
+    if cols is None:
+        turnover = np.abs(np.diff(weight, axis = 0, prepend = 0)).sum(axis = 1)
+    else: # 每天的成分股不同, 按(日期, 股票)对齐当天与前一天的权重
+        rows = np.broadcast_to(np.arange(T, dtype = np.int64)[:, None], cols.shape)
+        held = cols >= 0
+        width = max(int(cols.max()) + 1, 1)
+        keys = np.concatenate([(rows * width + cols)[held], ((rows + 1) * width + cols)[held]])
+        values = np.concatenate([weight[held], -weight[held]])
+        unique, inverse = np.unique(keys, return_inverse = True)
+        diff = np.bincount(inverse, weights = values)
+        turnover = np.bincount(unique // width, weights = np.abs(diff), minlength = T + 1)[:T]
+    return {'ic': ic, 'group': group_ret, 'long': long_ret, 'short': short_ret, 'turnover': turnover, 
+            'portfolio_ret': day_ret, 'net_ret': day_ret - cost_rate * turnover}
+
+
+_worker_ret = None # 子进程中共享的收益率矩阵, 由_init_worker在进程启动时设置一次
+
+def _init_worker(ret: np.ndarray) -> None:
+    global _worker_ret
+    _worker_ret = ret
+
+def _backtest_worker(alpha: np.ndarray, init_cap: float) -> (np.ndarray, np.ndarray):
+    return backtest_values(alpha, _worker_ret, init_cap)
+
+def _share(values: np.ndarray) -> (shared_memory.SharedMemory, tuple):
+    '''
+    将数组复制到共享内存中, 返回共享内存和子进程中读取该数组需要的(名称, shape, dtype)
+    '''
+    shm = shared_memory.SharedMemory(create = True, size = max(values.nbytes, 1))
+    np.ndarray(values.shape, dtype = values.dtype, buffer = shm.buf)[...] = values
+    return shm, (shm.name, values.shape, values.dtype.str)
+
+def _sweep_worker(alpha_spec: tuple, ret_spec: tuple, rows: np.ndarray, cols: Optional[np.ndarray], 
+                  ret_rows: np.ndarray, ret_cols: Optional[np.ndarray]) -> (np.ndarray, np.ndarray):
+    '''
+    在子进程中读取共享内存中的因子值和收益率, 计算整个区间每日的IC和组合收益率
+    '''
+    shms = [shared_memory.SharedMemory(name = spec[0]) for spec in (alpha_spec, ret_spec)]
+    try:
+        alpha, ret = [np.ndarray(spec[1], dtype = spec[2], buffer = shm.buf) for spec, shm in zip((alpha_spec, ret_spec), shms)]
+        ic, day_ret, _ = portfolio_values(take(alpha, rows, cols), take(ret, ret_rows, ret_cols))
+        del alpha, ret
+    finally:
+        for shm in shms:
+            shm.close()
+    return ic, day_ret
+
+
 class Backtest:
     '''
     回测类 \n
@@ -21,22 +156,55 @@ class Backtest:
     init_cap: 总资金 \n
     pool: 资产池, 目前支持的可选项有'all'(沪深全市场), 'hs300'(沪深300成分股, 实时跟踪),
     也可直接传入一个one-hot的pd.DataFrame \n
-    output: 回测输出, 可选项包括ic, pnl, weight, metrics
+    output: 回测输出, 可选项包括ic, pnl, weight, metrics \n
+    cache_size: 回测结果缓存的最大容量(字节), 缓存储存在PATH/../cache/, 超出容量时删除最久未使用的结果, 
+    设置为0时不使用缓存 \n
+    batch: 批量模式, 设置为True时不绘图也不展示回测指标, 只写入csv文件; 
+    回测结果的csv和图片均在后台线程中写入, 需要读取这些文件时先调用flush
     '''
     def __init__(self, PATH: str, start: str, end: str, init_cap: float = 1e8, 
-                 pool = 'all', output: list = ['ic', 'pnl', 'metrics']) -> None:
+                 pool = 'all', output: list = ['ic', 'pnl', 'metrics'], cache_size: float = 2 ** 28, 
+                 batch: bool = False) -> None:
         self.PATH = PATH
         self.STORE_PATH = os.path.join(PATH, '../alpha/') # 储存回测结果的路径
-        self.ret = get_data(PATH)['ret'].shift(-1) # 收益率
+        self.cache = ResultCache(os.path.join(PATH, '../cache/'), cache_size) if cache_size > 0 else None # 回测结果缓存
+        data = get_data(PATH)
+        self.data = data # 进程内共享的数据集, 各字段为只读的内存映射
+        self.index, self.columns = data['ret'].index, data['ret'].columns # 数据集的日期和股票代码
+        self.data_version = getattr(data, 'version', None) # 数据集的版本号, 数据集更新后回测结果缓存随之失效
         self.start = start
         self.end = end
         self.init_cap = init_cap
         self.pool_name, self.pool = self.get_pool(pool)
         self.output = output
+        self.batch = batch
+        self.writer = ArtifactWriter(render = not batch) # 在后台写入回测结果的csv和图片
+
+    def flush(self) -> None:
+        '''
+        等待后台写入的回测结果全部写入文件
+        '''
+        self.writer.flush()
+
+    @property
+    def ret(self) -> pd.DataFrame:
+        '''
+        次日收益率, 首次访问时由进程内共享的数据集计算一次, 只读; 
+        按块回测时使用take_ret从ret字段中读取, 不创建这一完整的数组
+        '''
+        return self.data['forward_ret']
+
+    def take_ret(self, ret_rows: np.ndarray, ret_cols: Optional[np.ndarray]) -> np.ndarray:
+        '''
+        按align返回的位置ret_rows, ret_cols取出次日收益率: 从内存映射的ret字段中取下一行, 只读取需要的日期
+        '''
+        ret = self.data['ret'].values
+        rows = np.where((ret_rows >= 0) & (ret_rows + 1 < len(ret)), ret_rows + 1, -1)
+        return take(ret, rows, ret_cols)
 
-    def get_pool(self, pool) -> (str, Optional[pd.DataFrame]):
+    def get_pool(self, pool) -> (str, Optional[Universe]):
         '''
-        获取股票池的DataFrame
+        获取股票池的成分股索引, 内置股票池在进程内只构建一次
         '''
         # 检查pool输入格式
         assert isinstance(pool, (str, pd.DataFrame)), 'pool should be str type or pd.DataFrame'
@@ -47,28 +215,72 @@ class Backtest:
                 return 'all', None
             # 沪深300
             elif pool == 'hs300':
-                pool = pd.read_csv(os.path.join(self.PATH, 'newdata/hs300.csv'), index_col = 0)
-                pool.index = pd.to_datetime(pool.index)
-                return 'hs300', pool
+                return 'hs300', load_universe(self.PATH, 'hs300', self.index, self.columns)
             # 不支持的字符串, 默认为all
             else:
                 print(f"unsupported pool {pool}, setting pool to 'all'")
                 return 'all', None
         
         else: # 自定义股票池, 需保证日期和股票名均在可回测范围内
-            assert pool.index.isin(self.ret.index).all(), 'invalid date'
-            assert pool.columns.isin(self.ret.columns).all(), 'invalid stock name'
-            return pool.index.name, pool
+            assert pool.index.isin(self.index).all(), 'invalid date'
+            assert pool.columns.isin(self.columns).all(), 'invalid stock name'
+            return pool.index.name, Universe(pool.reindex(index = self.index, columns = self.columns))
 
-    def get_ic(self, alpha: pd.DataFrame) -> pd.DataFrame:
+    def align(self, index: pd.Index, columns: pd.Index, start: str, end: str, 
+              pool: Optional[Universe]) -> (pd.Index, np.ndarray, Optional[np.ndarray], np.ndarray, Optional[np.ndarray]):
         '''
-        计算IC, rankIC
+        计算因子值在回测中的取值位置, 同一组日期和股票代码的因子共用: 回测期间内每天使用前一天的因子值,
+        资产池不为全市场时每天只取成分股所在的列 \n
+        返回回测期间的日期window, 因子值所在的行rows(-1表示无因子值), 列cols(None表示所有列, 
+        否则shape = (len(window), M), -1表示无成分股), 以及对齐的次日收益率在self.ret中的行ret_rows和列ret_cols(可以传入take_ret)
         '''
-        ic = pd.DataFrame(index = alpha.index, columns = ['IC', 'rankIC'])
-        for date in alpha.index:
-            ic.loc[date, 'IC'] = alpha.loc[date].corr(self.ret.loc[date])
-            ic.loc[date, 'rankIC'] = alpha.loc[date].corr(self.ret.loc[date], method = 'spearman')
-        return ic        
+        window = index[index.slice_indexer(start, end)] # 回测期间的日期
+        rows = index.get_indexer(window) - 1 # 平移1天后, 回测期间内每天对应的因子值所在行
+        ret_cols = self.columns.get_indexer(columns)
+        if pool is None:
+            cols = None
+            if ret_cols.tolist() == list(range(len(self.columns))): # 股票代码与数据集一致时直接取整行
+                ret_cols = None
+        else: # 使用因子值所在日期的成分股
+            cols = pool.members(index[np.maximum(rows, 0)], columns)
+            ret_cols = np.where(cols >= 0, ret_cols[cols], -1)
+        return window, rows, cols, self.index.get_indexer(window), ret_cols
+
+    def iter_chunks(self, alpha: pd.DataFrame, window: pd.Index, rows: np.ndarray, cols: Optional[np.ndarray], 
+                    ret_rows: np.ndarray, ret_cols: Optional[np.ndarray], chunk_size: Optional[int] = None):
+        '''
+        按日期分块取出回测需要的因子值和收益率, 依次返回(块的起始位置, 因子值, 收益率),
+        chunk_size为每块的日期数, 为None时整个回测区间作为一块; 收益率按块从内存映射的ret字段读取
+        '''
+        step = chunk_size if chunk_size is not None else max(len(window), 1)
+        values = alpha.values
+        for s in range(0, len(window), step):
+            alpha_chunk = take(values, rows[s: s + step], cols if cols is None else cols[s: s + step])
+            ret_chunk = self.take_ret(ret_rows[s: s + step], 
+                                      ret_cols if ret_cols is None or ret_cols.ndim == 1 else ret_cols[s: s + step])
+            yield s, alpha_chunk, ret_chunk
+
+    def get_ic(self, alpha):
+        '''
+        计算IC, rankIC: 对整个T×N的因子矩阵批量计算每日截面上因子与收益率的Pearson相关系数(IC)
+        和Spearman相关系数(rankIC) \n
+        alpha: 因子值, 也可传入{因子名称: 因子值}的字典以同时计算多个因子, 此时返回{因子名称: IC}的字典
+        '''
+        if isinstance(alpha, dict):
+            alphas = list(alpha.values())
+            index, columns = alphas[0].index, alphas[0].columns
+            values = np.stack([a.reindex(index = index, columns = columns).values for a in alphas])
+        else:
+            index, columns = alpha.index, alpha.columns
+            values = alpha.values
+        ret = self.ret.reindex(index = index, columns = columns).values # 与因子对齐的收益率
+        ic = cs_corr(values, ret)
+        rank_ic = cs_corr(values, ret, method = 'spearman')
+
+        if isinstance(alpha, dict):
+            return {name: pd.DataFrame({'IC': ic[k], 'rankIC': rank_ic[k]}, index = index) 
+                    for k, name in enumerate(alpha.keys())}
+        return pd.DataFrame({'IC': ic, 'rankIC': rank_ic}, index = index)
 
     def plot_ic(self, ic: pd.Series, ALPHA_PATH: str, name: str) -> None:
         '''
@@ -76,15 +288,16 @@ class Backtest:
         '''
         ic_mean = ic.mean(axis = 0).astype('float').round(4) # IC均值, 设置小数位数
         icir = (ic.mean(axis = 0) / ic.std(axis = 0)).astype('float').round(4) # ICIR, 设置小数位数
-        plt.figure(figsize = (8, 4))
-        plt.plot(ic.cumsum()) # IC累积值
-        plt.title(f'{name}_IC')
-        plt.legend([f'IC mean = {ic_mean["IC"]} \nICIR = {icir["IC"]}', \
-                    f'rankIC mean = {ic_mean["rankIC"]} \nrankICIR = {icir["rankIC"]}'])
-        plt.xlabel('date')
-        plt.ylabel('ic_cumsum', rotation = 0, labelpad = 10)
-        plt.grid()
-        plt.savefig(os.path.join(ALPHA_PATH, f'{name}_IC.jpg'))
+        ic_cumsum = ic.cumsum() # IC累积值
+        def draw(ax) -> None:
+            ax.plot(ic_cumsum)
+            ax.set_title(f'{name}_IC')
+            ax.legend([f'IC mean = {ic_mean["IC"]} \nICIR = {icir["IC"]}', \
+                       f'rankIC mean = {ic_mean["rankIC"]} \nrankICIR = {icir["rankIC"]}'])
+            ax.set_xlabel('date')
+            ax.set_ylabel('ic_cumsum', rotation = 0, labelpad = 10)
+            ax.grid()
+        self.writer.plot(draw, os.path.join(ALPHA_PATH, f'{name}_IC.jpg'))
 
     def get_weight(self, alpha: pd.DataFrame) -> pd.DataFrame:
         '''
@@ -109,32 +322,27 @@ class Backtest:
         ret = pnl.pct_change()
         ret_mean = (ret.mean() * 252).round(4)
         sharpe_ratio = ((ret.mean() / ret.std()) * np.sqrt(252)).round(4)
-        plt.figure(figsize = (8, 4))
-        plt.plot(pnl)
-        plt.title(f'{name}_PnL')
-        plt.legend([f'annually ret = {ret_mean} \nSharpe ratio = {sharpe_ratio}'])
-        plt.xlabel('date')
-        plt.ylabel('PnL', rotation = 0, labelpad = 10)
-        plt.grid()
-        plt.savefig(os.path.join(ALPHA_PATH, f'{name}_PnL.jpg'))
+        pnl = pnl.copy()
+        def draw(ax) -> None:
+            ax.plot(pnl)
+            ax.set_title(f'{name}_PnL')
+            ax.legend([f'annually ret = {ret_mean} \nSharpe ratio = {sharpe_ratio}'])
+            ax.set_xlabel('date')
+            ax.set_ylabel('PnL', rotation = 0, labelpad = 10)
+            ax.grid()
+        self.writer.plot(draw, os.path.join(ALPHA_PATH, f'{name}_PnL.jpg'))
 
     def max_drawdown(self, pnl: pd.Series) -> float:
         '''
         计算最大回撤
         '''
         pnl = pnl.values
-        max_drawdown = 0 # 记录最大回撤
-        max_value = pnl[0] # 记录目前PnL的最大值
-        for v in pnl[1:]:
-            if v > max_value:
-                max_value = v
-            else:
-                max_drawdown = max(max_drawdown, max_value - v)
-        return max_drawdown / pnl[0]
+        drawdown = np.maximum.accumulate(pnl) - pnl # 当前PnL与此前最大值之差
+        return drawdown.max() / pnl[0]
 
-    def get_metrics(self, ic: pd.Series, pnl: pd.Series, ALPHA_PATH: str, name: str) -> None:
+    def calc_metrics(self, ic: pd.DataFrame, pnl: pd.Series, alpha_name: str) -> pd.DataFrame:
         '''
-        计算指标
+        根据IC和PnL计算回测指标, 返回index为指标名称, columns为[alpha_name]的DataFrame
         '''
         ic_mean = ic.mean(axis = 0).astype('float').round(4) # IC均值
         icir = (ic.mean(axis = 0) / ic.std(axis = 0)).astype('float').round(4) # ICIR
@@ -149,17 +357,27 @@ class Backtest:
                                 index = ['IC均值', 'ICIR', 'rankIC均值', 'rankICIR',
                                          '年化收益率', '年化波动率', '夏普比率', 
                                          '最大回撤', '胜率'],
-                                columns = [name.split('_')[0]])
-        metrics.to_csv(os.path.join(ALPHA_PATH, f'{name}_metrics.csv'))
-        display(metrics) # 展示指标DataFrame
+                                columns = [alpha_name])
+        return metrics
+
+    def get_metrics(self, ic: pd.Series, pnl: pd.Series, ALPHA_PATH: str, name: str) -> pd.DataFrame:
+        '''
+        计算指标
+        '''
+        metrics = self.calc_metrics(ic, pnl, name.split('_')[0])
+        self.writer.write_csv(metrics, os.path.join(ALPHA_PATH, f'{name}_metrics.csv'))
+        if not self.batch:
+            display(metrics) # 展示指标DataFrame
+        return metrics
 
 
     def backtest(self, alpha: pd.DataFrame, alpha_name: str,
                  start: Optional[str] = None, end: Optional[str] = None, 
                  init_cap: Optional[float] = None, pool = None, 
-                 output: Optional[list] = None) -> None:
+                 output: Optional[list] = None, chunk_size: Optional[int] = None) -> dict:
         '''
-        回测函数: \n
+        回测函数: 返回{'ic': IC, 'pnl': PnL, 'metrics': 回测指标}, 若相同因子值和回测参数的结果已在缓存中, 
+        则直接使用缓存的IC和PnL \n
         alpha: 需要回测的因子
         alpha_name: 因子名称
         下面参数与回测类参数相同, 如不传入, 默认为回测类参数值
@@ -168,15 +386,124 @@ class Backtest:
         init_cap: 总资金 \n
         pool: 资产池, 目前支持的可选项有'all'(沪深全市场), 'hs300'(沪深300成分股, 实时跟踪),
         也可直接传入一个one-hot的pd.DataFrame \n
-        output: 回测输出, 可选项包括ic, pnl, weight, metrics
+        output: 回测输出, 可选项包括ic, pnl, weight, metrics \n
+        chunk_size: 流式回测时每块的日期数, 回测区间按日期分块计算, 峰值内存只取决于块的大小而与回测区间长度无关,
+        因子值也可以是基于内存映射数组(例如因子池中储存的因子)的pd.DataFrame; 为None时整个回测区间一次计算
         '''
-        # 检查, 创建储存回测结果的路径
-        if not os.path.exists(self.STORE_PATH):
-            os.mkdir(self.STORE_PATH)
-        ALPHA_PATH = os.path.join(self.STORE_PATH, alpha_name)
-        if not os.path.exists(ALPHA_PATH):
-            os.mkdir(ALPHA_PATH)
+        with profiler.stage('backtest', *alpha.shape):
+            # 检查, 创建储存回测结果的路径
+            if not os.path.exists(self.STORE_PATH):
+                os.mkdir(self.STORE_PATH)
+            ALPHA_PATH = os.path.join(self.STORE_PATH, alpha_name)
+            if not os.path.exists(ALPHA_PATH):
+                os.mkdir(ALPHA_PATH)
 
+            # 将未传入的参数设为与回测类一致
+            if start is None:
+                start = self.start
+            if end is None:
+                end = self.end
+            if init_cap is None:
+                init_cap = self.init_cap
+            if pool is None:
+                pool_name, pool = self.pool_name, self.pool
+            else:
+                pool_name, pool = self.get_pool(pool)
+            if output is None:
+                output = self.output
+
+            name = f'{alpha_name}_{start}_{end}_{pool_name}'
+            print(f'Start backtesting alpha {alpha_name}')
+
+            # 查找回测结果缓存, 需要输出权重时重新计算
+            cached = None
+            if self.cache is not None:
+                with profiler.stage('backtest.cache_get', *alpha.shape):
+                    key = self.cache.get_key(alpha, start = start, end = end, init_cap = init_cap, 
+                                             pool = 'all' if pool is None else pool.key, # 资产池使用成分股内容的哈希值
+                                             data = self.data_version, output = sorted(output))
+                    if 'weight' not in output:
+                        cached = self.cache.get(key)
+
+            if cached is not None:
+                ic, pnl = cached
+            else:
+                # 资产池筛选, 平移和截取回测区间, 按日期分块只取出回测需要的因子值和收益率,
+                # 每块计算完成后只保留每日的IC和组合收益率, 内存占用只取决于块的大小
+                with profiler.stage('backtest.align', *alpha.shape):
+                    window, rows, cols, ret_rows, ret_cols = self.align(alpha.index, alpha.columns, start, end, pool)
+                width = len(alpha.columns) if cols is None else cols.shape[-1] # 每日参与计算的股票个数
+                with profiler.stage('backtest.portfolio', len(window), width):
+                    chunks = self.iter_chunks(alpha, window, rows, cols, ret_rows, ret_cols, chunk_size)
+                    ic, day_ret, weights = [np.empty((0, 2))], [np.empty(0)], []
+                    for s, alpha_chunk, ret_chunk in chunks:
+                        ic_chunk, ret_chunk, weight = portfolio_values(alpha_chunk, ret_chunk)
+                        ic.append(ic_chunk)
+                        day_ret.append(ret_chunk)
+                        if 'weight' in output and chunk_size is None:
+                            weights.append(weight)
+                with profiler.stage('backtest.pnl', len(window)):
+                    ic, day_ret = np.concatenate(ic), np.concatenate(day_ret)
+                    sign, pnl = pnl_values(ic, day_ret, init_cap)
+                    ic = pd.DataFrame(ic, index = window, columns = ['IC', 'rankIC'])
+                    pnl = pd.Series(pnl, index = window)
+
+                if 'weight' in output: # 因子方向确定后输出权重, 分块时重新逐块计算权重并追加写入
+                    with profiler.stage('backtest.weight', len(window), len(alpha.columns)):
+                        WEIGHT_PATH = os.path.join(ALPHA_PATH, f'{name}_weight.csv')
+                        if chunk_size is not None:
+                            chunks = self.iter_chunks(alpha, window, rows, cols, ret_rows, ret_cols, chunk_size)
+                            weights = (portfolio_values(alpha_chunk, ret_chunk)[2] for _, alpha_chunk, ret_chunk in chunks)
+                        s = 0
+                        for weight in weights:
+                            dates = window[s: s + len(weight)]
+                            if cols is not None: # 将成分股的权重还原为全部股票的权重
+                                chunk_cols = cols[s: s + len(weight)]
+                                valid = chunk_cols >= 0
+                                full = np.zeros((len(weight), len(alpha.columns)))
+                                full[np.nonzero(valid)[0], chunk_cols[valid]] = weight[valid]
+                                weight = full
+                            weight = pd.DataFrame(sign * weight, index = dates, columns = alpha.columns)
+                            self.writer.write_csv(weight, WEIGHT_PATH, copy = False, mode = 'w' if s == 0 else 'a', header = s == 0)
+                            s += len(weight)
+                if self.cache is not None:
+                    with profiler.stage('backtest.cache_put', len(window)):
+                        self.cache.put(key, ic, pnl)
+
+            with profiler.stage('backtest.output', len(ic)):
+                if 'ic' in output:
+                    self.writer.write_csv(ic, os.path.join(ALPHA_PATH, f'{name}_IC.csv'))
+                    self.plot_ic(ic, ALPHA_PATH, name) # 绘制累积IC曲线
+                if 'pnl' in output:
+                    self.writer.write_csv(pnl, os.path.join(ALPHA_PATH, f'{name}_PnL.csv'))
+                    self.plot_pnl(pnl, ALPHA_PATH, name) # 绘制PnL曲线
+
+            # 计算回测指标
+            with profiler.stage('backtest.metrics', len(ic)):
+                if 'metrics' in output:
+                    metrics = self.get_metrics(ic, pnl, ALPHA_PATH, name)
+                else:
+                    metrics = self.calc_metrics(ic, pnl, name.split('_')[0])
+
+            print(f'Successfully backtest alpha {alpha_name} and store results to {ALPHA_PATH}')
+
+        return {'ic': ic, 'pnl': pnl, 'metrics': metrics}
+
+    def backtest_many(self, alphas: dict, start: Optional[str] = None, end: Optional[str] = None, 
+                      init_cap: Optional[float] = None, pool = None, 
+                      output: list = ['metrics'], max_workers: Optional[int] = None) -> pd.DataFrame:
+        '''
+        批量回测函数: 多进程并行回测多个因子, 返回所有因子回测指标的汇总表(index为因子名称, columns为指标名称) \n
+        alphas: {因子名称: 因子值}的字典, 因子值的index和columns以第一个因子为准对齐
+        下面参数与回测函数相同, 如不传入, 默认为回测类参数值
+        start: 回测开始的时间, 例如'20200101' \n
+        end: 回测结束的时间, 例如'20221231' \n
+        init_cap: 总资金 \n
+        pool: 资产池, 目前支持的可选项有'all'(沪深全市场), 'hs300'(沪深300成分股, 实时跟踪),
+        也可直接传入一个one-hot的pd.DataFrame \n
+        output: 回测输出, 可选项包括ic, pnl, metrics, 批量回测时不绘图 \n
+        max_workers: 进程数, 默认为CPU核数, 设置为1时在当前进程中串行回测
+        '''
         # 将未传入的参数设为与回测类一致
         if start is None:
             start = self.start
@@ -188,40 +515,195 @@ class Backtest:
             pool_name, pool = self.pool_name, self.pool
         else:
             pool_name, pool = self.get_pool(pool)
-        if output is None:
-            output = self.output
 
-        if pool is not None:
-            alpha = alpha[pool == 1] # 资产池内股票的因子值
-        alpha = alpha.shift(1).loc[start: end] # 回测期间内股票的因子值
+        # 资产池筛选, 平移和截取回测区间只计算一次索引, 所有因子共用
+        alpha_names = list(alphas.keys())
+        index, columns = alphas[alpha_names[0]].index, alphas[alpha_names[0]].columns
+        window, rows, cols, ret_rows, ret_cols = self.align(index, columns, start, end, pool)
+        ret = take(self.ret.values, ret_rows, ret_cols)
+
+        def prepare(alpha: pd.DataFrame) -> np.ndarray:
+            return take(alpha.reindex(index = index, columns = columns).values, rows, cols) # 资产池内股票的因子值
+
+        print(f'Start backtesting {len(alpha_names)} alphas')
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        max_workers = min(max_workers, len(alpha_names))
+        if max_workers <= 1:
+            results = [backtest_values(prepare(alphas[alpha_name]), ret, init_cap) for alpha_name in alpha_names]
+        else: # 收益率矩阵在每个子进程启动时传入一次, 之后每个任务只传入因子值
+            with ProcessPoolExecutor(max_workers = max_workers, initializer = _init_worker, 
+                                     initargs = (ret, )) as executor:
+                futures = [executor.submit(_backtest_worker, prepare(alphas[alpha_name]), init_cap) 
+                           for alpha_name in alpha_names]
+                results = [future.result() for future in futures]
+
+        # 汇总回测结果
+        metrics_list = []
+        for alpha_name, (ic, pnl) in zip(alpha_names, results):
+            ic = pd.DataFrame(ic, index = window, columns = ['IC', 'rankIC'])
+            pnl = pd.Series(pnl, index = window)
+            metrics = self.calc_metrics(ic, pnl, alpha_name)
+            metrics_list.append(metrics.T)
+
+            if output:
+                ALPHA_PATH = os.path.join(self.STORE_PATH, alpha_name)
+                os.makedirs(ALPHA_PATH, exist_ok = True)
+                name = f'{alpha_name}_{start}_{end}_{pool_name}'
+                if 'ic' in output:
+                    self.writer.write_csv(ic, os.path.join(ALPHA_PATH, f'{name}_IC.csv'))
+                if 'pnl' in output:
+                    self.writer.write_csv(pnl, os.path.join(ALPHA_PATH, f'{name}_PnL.csv'))
+                if 'metrics' in output:
+                    self.writer.write_csv(metrics, os.path.join(ALPHA_PATH, f'{name}_metrics.csv'), copy = False)
+
+        print(f'Successfully backtest {len(alpha_names)} alphas')
+        return pd.concat(metrics_list, axis = 0)
+
+    def analyze(self, alpha: pd.DataFrame, alpha_name: str, 
+                start: Optional[str] = None, end: Optional[str] = None, 
+                init_cap: Optional[float] = None, pool = None, 
+                n_groups: int = 10, cost_rate: float = 0.001) -> dict:
+        '''
+        分析函数: 一次性计算分层回测, 多空收益, 换手率和扣除交易费用后的PnL, 以及分年度的回测指标,
+        返回{'daily': 每日分析结果, 'metrics': 回测指标, 'yearly': 分年度回测指标}, 并储存在dir/alpha/alpha_name中 \n
+        alpha: 需要分析的因子 \n
+        alpha_name: 因子名称 \n
+        start, end, init_cap, pool: 与回测函数相同, 如不传入, 默认为回测类参数值 \n
+        n_groups: 分层的组数, 第n_groups组为多头方向 \n
+        cost_rate: 单边交易费率
+        '''
+        ALPHA_PATH = os.path.join(self.STORE_PATH, alpha_name)
+        os.makedirs(ALPHA_PATH, exist_ok = True)
+
+        # 将未传入的参数设为与回测类一致
+        if start is None:
+            start = self.start
+        if end is None:
+            end = self.end
+        if init_cap is None:
+            init_cap = self.init_cap
+        if pool is None:
+            pool_name, pool = self.pool_name, self.pool
+        else:
+            pool_name, pool = self.get_pool(pool)
         name = f'{alpha_name}_{start}_{end}_{pool_name}'
+        print(f'Start analyzing alpha {alpha_name}')
 
-        print(f'Start backtesting alpha {alpha_name}')
+        window, rows, cols, ret_rows, ret_cols = self.align(alpha.index, alpha.columns, start, end, pool)
+        res = analyze_values(take(alpha.values, rows, cols), take(self.ret.values, ret_rows, ret_cols), 
+                             cols, n_groups, cost_rate)
 
-        # 计算IC, rankIC
-        ic = self.get_ic(alpha)
-        
-        if 'ic' in output:
-            ic.to_csv(os.path.join(ALPHA_PATH, f'{name}_IC.csv'))
-            self.plot_ic(ic, ALPHA_PATH, name) # 绘制累积IC曲线
-        
-        if ic['IC'].mean() < 0:
-            alpha = -alpha    
-
-        # 计算权重
-        weight = self.get_weight(alpha)
-        if 'weight' in output:
-            weight.to_csv(os.path.join(ALPHA_PATH, f'{name}_weight.csv'))
-            
-        # 计算PnL
-        pnl = self.get_pnl(weight, init_cap)
-        pnl = pnl[start: end]
-        if 'pnl' in output:
-            pnl.to_csv(os.path.join(ALPHA_PATH, f'{name}_PnL.csv'))
-            self.plot_pnl(pnl, ALPHA_PATH, name) # 绘制累积IC曲线
-
-        # 计算回测指标
-        if 'metrics' in output:
-            self.get_metrics(ic, pnl, ALPHA_PATH, name)
-
-        print(f'Successfully backtest alpha {alpha_name} and store results to {ALPHA_PATH}')
\ No newline at end of file
+        # 当日权重对应次日的收益率, 平移1天后与PnL的日期对齐
+        daily = pd.DataFrame(res['group'], index = window, columns = [f'group{k + 1}' for k in range(n_groups)])
+        daily['long'], daily['short'] = res['long'], res['short']
+        daily['long_short'], daily['net'] = res['portfolio_ret'], res['net_ret']
+        daily = daily.shift(1)
+        daily.iloc[0] = 0
+        daily['turnover'] = res['turnover'] # 换手率为当日调仓的换手, 不平移
+        daily['pnl'] = init_cap * (1 + daily['long_short'].cumsum())
+        daily['pnl_net'] = init_cap * (1 + daily['net'].cumsum())
+        ic = pd.DataFrame(res['ic'], index = window, columns = ['IC', 'rankIC'])
+
+        def extra_metrics(daily: pd.DataFrame) -> list:
+            return [daily['turnover'].mean().round(4), (daily['net'].mean() * 252).round(4),
+                    (daily['net'].mean() / daily['net'].std() * np.sqrt(252)).round(4)]
+        extra_index = ['日均换手率', '扣费年化收益率', '扣费夏普比率']
+
+        # 全区间和分年度的回测指标, 分年度时以上一年最后一天的PnL为起点
+        metrics = self.calc_metrics(ic, daily['pnl'], alpha_name)
+        metrics = pd.concat([metrics, pd.DataFrame(extra_metrics(daily), index = extra_index, columns = [alpha_name])])
+        yearly = []
+        years = window.year
+        for year in np.unique(years):
+            loc = np.nonzero(years == year)[0]
+            first = max(loc[0] - 1, 0)
+            year_metrics = self.calc_metrics(ic.iloc[loc], daily['pnl'].iloc[first: loc[-1] + 1], str(year))
+            year_extra = pd.DataFrame(extra_metrics(daily.iloc[loc]), index = extra_index, columns = [str(year)])
+            yearly.append(pd.concat([year_metrics, year_extra]).T)
+        yearly = pd.concat(yearly, axis = 0) if yearly else pd.DataFrame(columns = metrics.index)
+
+        self.writer.write_csv(daily, os.path.join(ALPHA_PATH, f'{name}_analysis.csv'))
+        self.writer.write_csv(metrics, os.path.join(ALPHA_PATH, f'{name}_analysis_metrics.csv'))
+        self.writer.write_csv(yearly, os.path.join(ALPHA_PATH, f'{name}_yearly.csv'))
+        if not self.batch:
+            display(yearly) # 展示分年度指标
+        print(f'Successfully analyze alpha {alpha_name} and store results to {ALPHA_PATH}')
+        return {'daily': daily, 'metrics': metrics, 'yearly': yearly}
+
+    def sweep(self, alphas, windows: list, pools: Optional[list] = None, params: Optional[dict] = None, 
+              init_cap: Optional[float] = None, max_workers: Optional[int] = None) -> pd.DataFrame:
+        '''
+        参数扫描函数: 对因子(或因子参数) × 资产池 × 回测区间的所有组合回测, 返回每个组合一行的回测指标表 \n
+        每个因子在每个资产池上只在覆盖所有回测区间的整个区间上计算一次每日的IC和组合收益率(各日期相互独立),
+        各回测区间直接截取后确定因子方向并计算PnL和指标, 结果与逐个调用回测函数相同 \n
+        alphas: {因子名称: 因子值}的字典, 或由params中的参数计算因子值的函数 \n
+        windows: 回测区间的列表, 例如[('20200101', '20201231'), ('20210101', '20211231')] \n
+        pools: 资产池的列表, 例如['all', 'hs300'], 默认为回测类的资产池 \n
+        params: alphas为函数时的参数网格, 例如{'d': [1, 5, 20]}, 每个参数组合计算一个因子 \n
+        init_cap: 总资金, 默认为回测类参数值 \n
+        max_workers: 进程数, 默认为CPU核数, 设置为1时在当前进程中串行计算, 
+        多进程时收益率和因子值通过共享内存传给子进程
+        '''
+        if init_cap is None:
+            init_cap = self.init_cap
+        pools = [(self.pool_name, self.pool)] if pools is None else [self.get_pool(pool) for pool in pools]
+
+        # 由参数网格计算因子, 因子名称包含参数值
+        param_values = {}
+        if callable(alphas):
+            func, alphas = alphas, {}
+            for combo in itertools.product(*params.values()):
+                combo = dict(zip(params.keys(), combo))
+                alpha_name = f"{func.__name__}({', '.join(f'{k}={v}' for k, v in combo.items())})"
+                alphas[alpha_name] = func(**combo)
+                param_values[alpha_name] = combo
+        alpha_names = list(alphas.keys())
+
+        # 每个(因子, 资产池)在覆盖所有回测区间的整个区间上计算一次
+        start, end = min(w[0] for w in windows), max(w[1] for w in windows)
+        tasks = []
+        for alpha_name, (pool_name, pool) in itertools.product(alpha_names, pools):
+            alpha = alphas[alpha_name]
+            tasks.append((alpha_name, pool_name) + self.align(alpha.index, alpha.columns, start, end, pool))
+        print(f'Start sweeping {len(alpha_names)} alphas, {len(pools)} pools and {len(windows)} windows')
+
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        max_workers = min(max_workers, len(tasks))
+        if max_workers <= 1:
+            results = [portfolio_values(take(alphas[alpha_name].values, rows, cols), 
+                                        take(self.ret.values, ret_rows, ret_cols))[:2]
+                       for alpha_name, _, _, rows, cols, ret_rows, ret_cols in tasks]
+        else: # 收益率和因子值只复制一次到共享内存, 子进程直接读取
+            shms = {}
+            try:
+                shms['ret'] = _share(np.ascontiguousarray(self.ret.values))
+                for alpha_name in alpha_names:
+                    shms[alpha_name] = _share(np.ascontiguousarray(alphas[alpha_name].values))
+                with ProcessPoolExecutor(max_workers = max_workers) as executor:
+                    futures = [executor.submit(_sweep_worker, shms[alpha_name][1], shms['ret'][1], 
+                                               rows, cols, ret_rows, ret_cols)
+                               for alpha_name, _, _, rows, cols, ret_rows, ret_cols in tasks]
+                    results = [future.result() for future in futures]
+            finally:
+                for shm, _ in shms.values():
+                    shm.close()
+                    shm.unlink()
+
+        # 截取各回测区间, 确定因子方向并计算回测指标
+        records = []
+        for (alpha_name, pool_name, full_window, *_), (ic, day_ret) in zip(tasks, results):
+            for window_start, window_end in windows:
+                loc = full_window.slice_indexer(window_start, window_end)
+                window = full_window[loc]
+                _, pnl = pnl_values(ic[loc], day_ret[loc], init_cap)
+                metrics = self.calc_metrics(pd.DataFrame(ic[loc], index = window, columns = ['IC', 'rankIC']), 
+                                            pd.Series(pnl, index = window), alpha_name)
+                record = {'alpha_name': alpha_name, **param_values.get(alpha_name, {}), 
+                          'start': window_start, 'end': window_end, 'pool': pool_name}
+                record.update(metrics[alpha_name])
+                records.append(record)
+
+        print(f'Successfully sweep {len(tasks)} alphas and pools over {len(windows)} windows')
+        return pd.DataFrame(records)
@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+import os
+import json
+import hashlib
+from typing import Optional
+
+
+class ResultCache:
+    '''
+    回测结果缓存: 以因子值和回测参数的哈希值为键, 每个回测结果储存为一个.npz文件, 包括IC, rankIC和PnL \n
+    CACHE_PATH: 缓存路径 \n
+    max_size: 缓存的最大容量(字节), 超出时删除最久未使用的回测结果
+    '''
+    def __init__(self, CACHE_PATH: str, max_size: float = 2 ** 28) -> None:
+        self.CACHE_PATH = CACHE_PATH
+        self.max_size = max_size
+
+    def get_key(self, alpha: pd.DataFrame, **params) -> str:
+        '''
+        计算因子值(包括日期和股票代码)与回测参数的哈希值
+        '''
+        h = hashlib.blake2b(digest_size = 16)
+        h.update(np.ascontiguousarray(alpha.values, dtype = np.float64))
+        h.update(np.asarray(alpha.index.values, dtype = 'datetime64[ns]'))
+        h.update('\n'.join(map(str, alpha.columns)).encode())
+        for key, value in sorted(params.items()):
+            if isinstance(value, pd.DataFrame): # 自定义资产池等参数使用其内容的哈希值
+                value = self.get_key(value)
+            h.update(json.dumps([key, value], default = str).encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[tuple]:
+        '''
+        读取回测结果, 返回(IC, PnL), 若不存在则返回None
+        '''
+        FILE_PATH = os.path.join(self.CACHE_PATH, f'{key}.npz')
+        if not os.path.exists(FILE_PATH):
+            return None
+        with np.load(FILE_PATH) as f:
+            index = pd.DatetimeIndex(f['date'], name = 'date')
+            ic = pd.DataFrame(f['ic'], index = index, columns = ['IC', 'rankIC'])
+            pnl = pd.Series(f['pnl'], index = index)
+        os.utime(FILE_PATH) # 更新访问时间, 用于淘汰最久未使用的结果
+        return ic, pnl
+
+    def put(self, key: str, ic: pd.DataFrame, pnl: pd.Series) -> None:
+        '''
+        储存回测结果, 并在缓存超出容量时淘汰最久未使用的结果
+        '''
+        if not os.path.exists(self.CACHE_PATH):
+            os.mkdir(self.CACHE_PATH)
+        FILE_PATH = os.path.join(self.CACHE_PATH, f'{key}.npz')
+        with open(FILE_PATH + '.tmp', 'wb') as f:
+            np.savez(f, date = np.asarray(ic.index.values, dtype = 'datetime64[ns]'), 
+                     ic = ic[['IC', 'rankIC']].values.astype(np.float64), pnl = pnl.values.astype(np.float64))
+        os.replace(FILE_PATH + '.tmp', FILE_PATH)
+        self.evict()
+
+    def evict(self) -> None:
+        '''
+        按最近使用时间从早到晚删除回测结果, 直到缓存总大小不超过max_size
+        '''
+        files = [entry for entry in os.scandir(self.CACHE_PATH) if entry.name.endswith('.npz')]
+        files = sorted(files, key = lambda entry: entry.stat().st_mtime)
+        total_size = sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if total_size <= self.max_size:
+                break
+            total_size -= entry.stat().st_size
+            os.remove(entry.path)
@@ -1,71 +1,331 @@
 import numpy as np
 import pandas as pd
 
+import io
 import os
+import json
+import time
 import pickle
+import tracemalloc
+from collections.abc import Mapping
+from typing import Optional
+from . import profiler
 
-def get_data(PATH: str, store = True) -> dict:
+RAW_FIELDS = ['cumadj', 'volume', 'open', 'high', 'low', 'close', 'amount'] # 构建dataset需要的原始字段
+# 由一般字段派生的字段, 首次访问时计算一次, 之后共享: {派生字段名称: 计算函数}
+DERIVED_FIELDS = {
+    'forward_ret': lambda data: data['ret'].shift(-1).values, # 次日收益率, 回测时与当日因子值对齐
+}
+_REGISTRY = {} # 进程内共享的数据集: {(数据集路径, 版本号): Dataset}
+
+
+class Dataset(Mapping):
     '''
-    预处理数据: 得到一个存储各字段数据的字典data, 其keys为字段名称(str) \n
-    PATH: 存储数据的路径, 设置为本repo的路径 \n    
-    store: 若设置为True, 则创建文件夹PATH/../dataset/并在文件夹下储存dataset为.pkl文件, 若文件已存在则直接读取
-    data有两个特殊字段: data['date']和data['id'], 分别为shape = (T,)和shape = (N,)的pd.DataFrame, 
-    表示数据的时间段和包含的股票ID \n
-    data的一般字段, 是一个shape = (T, N)的pd.DataFrame, 表示keys对应的字段数据, 
-    例如data['close']表示股票的收盘价数据 \n
-    注: 本系统数据基于20200101-20221231的沪深全市场股票, 于是data['date']为20200101-20221231之间的所有交易日, 
-    data['id']为这段时间沪深全市场股票代码
+    按字段存储的数据集: 每个字段储存为一个.npy文件, 读取时使用内存映射, 
+    首次访问某个字段时才加载该字段, 例如data['ret']只会读取收益率数据 \n
+    STORE_FOLDER: 数据集文件夹, 包含date.npy, id.npy, meta.json和各字段的.npy文件
+    '''
+    def __init__(self, STORE_FOLDER: str) -> None:
+        self.STORE_FOLDER = STORE_FOLDER
+        with open(os.path.join(STORE_FOLDER, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.fields = self.meta['fields'] # 一般字段的名称
+        self.version = self.meta.get('version', 0) # 数据集的版本号, 每次创建或更新数据集时改变
+        self.date = np.load(os.path.join(STORE_FOLDER, 'date.npy'))
+        self.id = np.load(os.path.join(STORE_FOLDER, 'id.npy'))
+        self.index = pd.DatetimeIndex(self.date, name = 'date')
+        self.columns = pd.Index(self.id, dtype = object)
+        self._arrays = {} # 已经打开的字段, 为只读的内存映射数组
+
+    def __getitem__(self, key: str):
+        if key == 'date':
+            return self.date
+        if key == 'id':
+            return self.id
+        if key in DERIVED_FIELDS:
+            if key not in self._arrays: # 首次访问时计算, 设为只读后共享
+                with profiler.stage(f'dataset.derive.{key}', len(self.date), len(self.id)):
+                    values = np.ascontiguousarray(DERIVED_FIELDS[key](self))
+                values.flags.writeable = False
+                self._arrays[key] = values
+        elif key not in self.fields:
+            raise KeyError(key)
+        elif key not in self._arrays: # 首次访问时打开内存映射
+            self._arrays[key] = np.load(os.path.join(self.STORE_FOLDER, f'{key}.npy'), mmap_mode = 'r')
+        return pd.DataFrame(self._arrays[key], index = self.index, columns = self.columns, copy = False)
+
+    def __iter__(self):
+        return iter(['date', 'id'] + self.fields)
+
+    def __len__(self) -> int:
+        return len(self.fields) + 2
+
+
+def store_data(data: dict, STORE_FOLDER: str) -> None:
+    '''
+    将数据字典按字段储存为.npy文件, 最后写入meta.json, meta.json存在即表示数据集完整
     '''
-    STORE_PATH = os.path.join(PATH, '../dataset/data.pkl') # Dataset存储路径
-    if store and os.path.exists(STORE_PATH): # 若Dataset文件存在且选择读取, 则直接读取数据
-        with open(STORE_PATH, 'rb') as f:
-            data = pickle.load(f)
-        print(f'Successfully load data from {STORE_PATH}')
+    if not os.path.exists(STORE_FOLDER):
+        os.mkdir(STORE_FOLDER)
+    META_PATH = os.path.join(STORE_FOLDER, 'meta.json')
+    if os.path.exists(META_PATH): # 覆盖旧数据集前先使其失效
+        os.remove(META_PATH)
+    np.save(os.path.join(STORE_FOLDER, 'date.npy'), np.asarray(data['date'], dtype = 'datetime64[ns]'))
+    np.save(os.path.join(STORE_FOLDER, 'id.npy'), np.asarray(data['id']).astype(str))
+    fields = [key for key in data.keys() if key not in ['date', 'id']]
+    for key in fields:
+        np.save(os.path.join(STORE_FOLDER, f'{key}.npy'), np.ascontiguousarray(data[key]))
+    with open(META_PATH, 'w') as f:
+        json.dump({'fields': fields, 'version': time.time_ns()}, f)
+
+
+def load_dataset(STORE_FOLDER: str) -> Dataset:
+    '''
+    从进程内的共享注册表中获取数据集: 相同路径和版本的数据集在进程内只打开一次, 
+    各Backtest, AlphaPool共享同一份只读的字段数组和派生字段, 数据集更新后(版本号改变)重新打开 \n
+    STORE_FOLDER: 数据集文件夹, 需包含meta.json
+    '''
+    with open(os.path.join(STORE_FOLDER, 'meta.json'), 'r') as f:
+        version = json.load(f).get('version', 0)
+    folder = os.path.realpath(STORE_FOLDER)
+    key = (folder, version)
+    if key not in _REGISTRY:
+        for old_key in [k for k in _REGISTRY if k[0] == folder]: # 释放同一路径下旧版本的数据集
+            del _REGISTRY[old_key]
+        _REGISTRY[key] = Dataset(STORE_FOLDER)
+    return _REGISTRY[key]
+
+
+def pivot_fields(raw_data: pd.DataFrame, columns: Optional[pd.Index] = None, dtype = 'float64') -> (pd.DatetimeIndex, pd.Index, dict):
+    '''
+    一次性将长表格式的原始日行情数据转换为shape = (T, N)的数组 \n
+    raw_data: 包含stk_id, date和RAW_FIELDS各列的原始数据 \n
+    columns: 股票代码, 为None时使用raw_data中出现的所有股票代码(排序后) \n
+    dtype: 数组的数据类型, 可选'float64'或'float32' \n
+    返回日期, 股票代码和{原始字段名称: 数组}的字典, 无数据的位置为NaN
+    '''
+    date_codes, index = pd.factorize(raw_data['date'], sort = True)
+    if columns is None:
+        id_codes, columns = pd.factorize(raw_data['stk_id'], sort = True)
+    else:
+        id_codes = columns.get_indexer(raw_data['stk_id'])
+    raw = {}
+    for item in RAW_FIELDS:
+        raw[item] = np.full((len(index), len(columns)), np.nan, dtype = dtype)
+        raw[item][date_codes, id_codes] = raw_data[item].values
+    return pd.DatetimeIndex(index, name = 'date'), pd.Index(columns, dtype = object), raw
+
+
+def derive_fields(raw: dict, suspend: np.ndarray, prev_close: Optional[np.ndarray] = None) -> dict:
+    '''
+    由原始字段计算dataset的一般字段, 计算过程中原地修改raw中的数组以减少内存占用 \n
+    raw: pivot_fields得到的{原始字段名称: shape = (T, N)的数组}, 包含RAW_FIELDS中的所有字段 \n
+    suspend: 与raw对齐的停牌数据, 0表示未停牌, 缺失为NaN \n
+    prev_close: 第一个日期前一交易日复权后的收盘价, 用于计算第一个日期的收益率, 为None时第一个日期收益率为NaN
+    '''
+    cumadj = raw.pop('cumadj')
+    data = {}
+    # 创建Volume字段
+    data['volume'] = raw.pop('volume')
+    data['volume'][~(data['volume'] > 1e-8)] = np.nan # 仅保留交易量>0的值
+    not_suspend = suspend == 0
+    tradable = not_suspend & ~np.isnan(data['volume'])
+
+    # 创建OHLC字段
+    for item in ['open', 'high', 'low', 'close']:
+        data[item] = raw.pop(item)
+        data[item] *= cumadj # 复权
+        data[item][~tradable] = np.nan # 除去停牌和交易量为0的股票
+
+    # 创建ret字段
+    close = data['close']
+    data['ret'] = np.empty_like(close)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        data['ret'][1:] = close[1:] / close[:-1] - 1
+        data['ret'][0] = np.nan if prev_close is None else close[0] / prev_close - 1
+
+    # 创建vwap字段
+    data['vwap'] = raw.pop('amount')
+    data['vwap'] *= cumadj # 复权
+    data['vwap'][~not_suspend] = np.nan # 除去停牌的股票
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        data['vwap'] /= data['volume'] # 交易量为0的股票为NaN
+    return data
+
 
-    else: # 创建新的Dataset   
-        print('Start creating dataset')
-        # 读取原始股票日行情数据
-        raw_data = pd.read_feather(os.path.join(PATH, '../data/stk_daily.feather'))
-        raw_data = raw_data[raw_data['stk_id'].apply(lambda x: not x.endswith('BJ'))] # 去掉北交所股票
-        raw_data = list(raw_data.groupby('stk_id'))
+def build_data(PATH: str, dtype = 'float64') -> dict:
+    '''
+    从原始数据创建dataset, 返回{'date': 日期, 'id': 股票代码, 字段名称: shape = (T, N)的数组}的字典 \n
+    PATH: 存储数据的路径, 设置为本repo的路径 \n
+    dtype: 数组的数据类型, 可选'float64'或'float32'
+    '''
+    # 读取原始股票日行情数据, 只读取需要的列
+    with profiler.stage('build_data.read') as stage:
+        raw_data = pd.read_feather(os.path.join(PATH, '../data/stk_daily.feather'), columns = ['stk_id', 'date'] + RAW_FIELDS)
+        raw_data = raw_data[~raw_data['stk_id'].str.endswith('BJ')] # 去掉北交所股票
+        stage.rows, stage.cols = raw_data.shape
+    with profiler.stage('build_data.pivot', len(raw_data)) as stage:
+        index, columns, raw = pivot_fields(raw_data, dtype = dtype)
+        stage.cols = len(columns)
+    del raw_data
 
-        # 读取停盘数据
+    # 读取停盘数据, 与原始数据对齐
+    with profiler.stage('build_data.suspend', len(index), len(columns)):
         suspend = pd.read_csv(os.path.join(PATH, 'newdata/suspend.csv'), index_col = 0)
         suspend.index = pd.to_datetime(suspend.index)
+        suspend = suspend.reindex(index = index, columns = columns).values
+
+    data = {'date': index.values, 'id': columns.values.astype(str)}
+    with profiler.stage('build_data.derive', len(index), len(columns)):
+        data.update(derive_fields(raw, suspend))
+    return data
+
+
+def append_rows(FILE_PATH: str, values: np.ndarray) -> bool:
+    '''
+    在.npy文件末尾原地追加行, 仅重写文件头中的shape; 若文件头长度改变导致无法原地追加, 则不修改文件并返回False
+    '''
+    with open(FILE_PATH, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            write_header = np.lib.format.write_array_header_1_0
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            write_header = np.lib.format.write_array_header_2_0
+        assert not fortran_order and tuple(values.shape[1:]) == tuple(shape[1:]), f'shape mismatch: {FILE_PATH}'
+        header_length = f.tell()
+
+        # 生成新的文件头, 长度不变时才写入
+        header = io.BytesIO()
+        write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 
+                              'shape': (shape[0] + len(values), ) + tuple(shape[1:])})
+        if header.tell() != header_length:
+            return False
+        f.seek(0)
+        f.write(header.getvalue())
+        f.seek(header_length + int(np.prod(shape)) * dtype.itemsize)
+        f.write(np.ascontiguousarray(values, dtype = dtype).tobytes())
+        f.truncate()
+    return True
 
-        # 将股票累积复权因子拼接成index为日期，columns为股票代码的DataFrame
-        cumadj = pd.concat([d[1].set_index('date')['cumadj'].rename(d[0]) for d in raw_data], axis = 1)
 
-        # 创建data字典和date, id字段
-        data = {'date': np.array(list(cumadj.index)), 'id': np.array(cumadj.columns)}
+def update_data(PATH: str) -> Dataset:
+    '''
+    增量更新dataset: 只读取PATH/../data/stk_daily.feather中晚于dataset最后一个交易日的数据, 
+    计算新交易日的各字段(收益率使用dataset中最后一个交易日的收盘价), 并原地追加到dataset的.npy文件中 \n
+    新上市的股票作为新的列加入dataset(排在已有股票之后), 历史数据为NaN, 此时需要重写各字段文件 \n
+    PATH: 存储数据的路径, 设置为本repo的路径
+    '''
+    import pyarrow.dataset as ds
 
-        # 创建Volume字段
-        data['volume'] = pd.concat([d[1].set_index('date')['volume'].rename(d[0]) for d in raw_data], axis = 1)
-        data['volume'] = data['volume'][data['volume'] > 1e-8] # 仅保留交易量>0的值   
+    STORE_FOLDER = os.path.join(PATH, '../dataset/') # Dataset存储路径
+    META_PATH = os.path.join(STORE_FOLDER, 'meta.json')
+    assert os.path.exists(META_PATH), f'dataset does not exist in {STORE_FOLDER}, please create it by get_data'
+    data = Dataset(STORE_FOLDER)
+    last_date = data.index[-1]
 
-        # 创建OHLC字段
-        for item in ['open', 'high', 'low', 'close']:
-            raw_item = pd.concat([d[1].set_index('date')[item].rename(d[0]) for d in raw_data], axis = 1)
-            data[item] = (raw_item * cumadj)[suspend == 0][data['volume'] > 1e-8] # 复权, 并除去停牌和交易量为0的股票
+    # 只读取新交易日的原始数据
+    FEATHER_PATH = os.path.join(PATH, '../data/stk_daily.feather')
+    raw_data = ds.dataset(FEATHER_PATH, format = 'feather').to_table(columns = ['stk_id', 'date'] + RAW_FIELDS, 
+                                                                     filter = ds.field('date') > last_date)
+    raw_data = raw_data.to_pandas()
+    raw_data = raw_data[~raw_data['stk_id'].str.endswith('BJ')] # 去掉北交所股票
+    if len(raw_data) == 0:
+        print(f'Dataset in {STORE_FOLDER} is already up to date')
+        return load_dataset(STORE_FOLDER)
 
-        # 创建ret字段
-        data['ret'] = data['close'].pct_change(fill_method = None)
+    print(f'Start updating dataset from {last_date.date()}')
+    # 新上市的股票排在已有股票之后
+    new_id = np.sort(raw_data.loc[~raw_data['stk_id'].isin(data.columns), 'stk_id'].unique()).astype(str)
+    columns = data.columns.append(pd.Index(new_id, dtype = object))
 
-        # 创建vwap字段
-        amount = pd.concat([d[1].set_index('date')['amount'].rename(d[0]) for d in raw_data], axis = 1)
-        data['vwap'] = (amount * cumadj)[suspend == 0] / data['volume'] # 复权, 并除去停牌和交易量为0的股票
+    # 计算新交易日的各字段
+    index, columns, raw = pivot_fields(raw_data, columns, dtype = data['close'].values.dtype)
+    suspend = pd.read_csv(os.path.join(PATH, 'newdata/suspend.csv'), index_col = 0)
+    suspend.index = pd.to_datetime(suspend.index)
+    suspend = suspend.reindex(index = index, columns = columns).values
+    prev_close = np.append(data['close'].values[-1], np.full(len(new_id), np.nan))
+    new_data = derive_fields(raw, suspend, prev_close)
+    new_date = index.values
 
-        if store: # 若选择储存Dataset文件, 则dump为.pkl文件
-            STORE_FOLDER = os.path.join(PATH, '../dataset/')
-            if not os.path.exists(STORE_FOLDER):
-                os.mkdir(STORE_FOLDER)
-            with open(STORE_PATH, 'wb') as f:
-                pickle.dump(data, f)
-            print(f'Successfully create dataset in {STORE_PATH}')
-        else:
-            print('Successfully create dataset')
+    # 写入数据集, 写入过程中删除meta.json, 使中断的更新不会被当作完整的数据集读取
+    os.remove(META_PATH)
+    if not append_rows(os.path.join(STORE_FOLDER, 'date.npy'), new_date):
+        np.save(os.path.join(STORE_FOLDER, 'date.npy'), np.concatenate([data.date, new_date]))
+    if len(new_id) > 0:
+        np.save(os.path.join(STORE_FOLDER, 'id.npy'), np.asarray(columns).astype(str))
+    for key in data.fields:
+        FIELD_PATH = os.path.join(STORE_FOLDER, f'{key}.npy')
+        values = new_data[key]
+        if len(new_id) > 0 or not append_rows(FIELD_PATH, values): # 有新股票时需要重写整个文件
+            old_values = np.load(FIELD_PATH, mmap_mode = 'r')
+            old_values = np.pad(old_values, ((0, 0), (0, len(new_id))), constant_values = np.nan)
+            np.save(FIELD_PATH + '.tmp.npy', np.concatenate([old_values, values], axis = 0))
+            os.replace(FIELD_PATH + '.tmp.npy', FIELD_PATH)
+    with open(META_PATH, 'w') as f:
+        json.dump(dict(data.meta, version = time.time_ns()), f)
+
+    print(f'Successfully append {len(new_date)} days and {len(new_id)} new stocks to dataset in {STORE_FOLDER}')
+    return load_dataset(STORE_FOLDER)
+
+
+def get_data(PATH: str, store = True, dtype = 'float64') -> Mapping:
+    '''
+    预处理数据: 得到一个存储各字段数据的字典data, 其keys为字段名称(str) \n
+    PATH: 存储数据的路径, 设置为本repo的路径 \n    
+    store: 若设置为True, 则创建文件夹PATH/../dataset/并在文件夹下按字段储存dataset为.npy文件, 
+    若文件已存在则直接读取, 此时返回的data为按字段懒加载的Dataset, 各字段使用内存映射读取, 
+    同一进程中多次读取同一版本的数据集时返回同一个Dataset \n
+    dtype: 创建dataset时各字段的数据类型, 可选'float64'或'float32', 使用'float32'可减少一半的内存和存储占用 \n
+    data有两个特殊字段: data['date']和data['id'], 分别为shape = (T,)和shape = (N,)的np.ndarray, 
+    表示数据的时间段和包含的股票ID \n
+    data的一般字段, 是一个shape = (T, N)的pd.DataFrame, 表示keys对应的字段数据, 
+    例如data['close']表示股票的收盘价数据 \n
+    注: 本系统数据基于20200101-20221231的沪深全市场股票, 于是data['date']为20200101-20221231之间的所有交易日, 
+    data['id']为这段时间沪深全市场股票代码
+    '''
+    STORE_FOLDER = os.path.join(PATH, '../dataset/') # Dataset存储路径
+    with profiler.stage('get_data') as stage:
+        PKL_PATH = os.path.join(STORE_FOLDER, 'data.pkl') # 旧版本的.pkl格式Dataset
+        if store and os.path.exists(os.path.join(STORE_FOLDER, 'meta.json')): # 若Dataset文件存在且选择读取, 则直接读取数据
+            with profiler.stage('get_data.load'):
+                data = load_dataset(STORE_FOLDER)
+            print(f'Successfully load data from {STORE_FOLDER}')
+
+        elif store and os.path.exists(PKL_PATH): # 将旧版本的.pkl文件转换为按字段储存的格式
+            with profiler.stage('get_data.convert'):
+                with open(PKL_PATH, 'rb') as f:
+                    store_data(pickle.load(f), STORE_FOLDER)
+                data = load_dataset(STORE_FOLDER)
+            print(f'Successfully convert {PKL_PATH} to dataset in {STORE_FOLDER}')
+
+        else: # 创建新的Dataset   
+            print('Start creating dataset')
+            with profiler.stage('get_data.build'):
+                tracing = tracemalloc.is_tracing()
+                if not tracing: # 记录创建过程中的内存峰值
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+                data = build_data(PATH, dtype)
+                peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                if not tracing:
+                    tracemalloc.stop()
+            print(f'Peak memory of creating dataset: {peak:.1f} MB')
+
+            if store: # 若选择储存Dataset文件, 则按字段储存为.npy文件
+                with profiler.stage('get_data.store'):
+                    store_data(data, STORE_FOLDER)
+                    data = load_dataset(STORE_FOLDER)
+                print(f'Successfully create dataset in {STORE_FOLDER}')
+            else:
+                index = pd.DatetimeIndex(data['date'], name = 'date')
+                columns = pd.Index(data['id'], dtype = object)
+                for key in data.keys():
+                    if key not in ['date', 'id']:
+                        data[key] = pd.DataFrame(data[key], index = index, columns = columns, copy = False)
+                print('Successfully create dataset')
+
+        stage.rows, stage.cols = len(data['date']), len(data['id'])
 
     return data
-    
-        
-    
\ No newline at end of file
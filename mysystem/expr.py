@@ -0,0 +1,210 @@
+import numpy as np
+import pandas as pd
+
+from collections import OrderedDict
+from . import utils
+
+# 算子名称与计算函数, 计算函数的输入输出均为shape = (T, N)的np.ndarray
+OPS = {
+    'add': np.add, 'sub': np.subtract, 'mul': np.multiply, 'div': np.true_divide, 'pow': np.power,
+    'neg': np.negative, 'abs': np.abs, 'log': np.log, 'sign': np.sign,
+    'delay': utils.delay, 'delta': utils.delta, 'ts_sum': utils.ts_sum, 'ts_mean': utils.ts_mean,
+    'ts_std': utils.ts_std, 'ts_rank': utils.ts_rank, 'ts_corr': utils.ts_corr, 'decay_linear': utils.decay_linear,
+    'rank': utils.cs_rank, 'zscore': utils.cs_zscore, 'winsorize': utils.cs_winsorize,
+}
+SYMBOLS = {'add': '+', 'sub': '-', 'mul': '*', 'div': '/', 'pow': '**'} # 二元运算符
+
+
+class Expr:
+    '''
+    因子表达式的节点: 由算子名称op和参数args构成, 参数可以是子表达式或常数 \n
+    结构相同的表达式有相同的key, 计算时视为同一个节点, 只计算一次
+    '''
+    def __init__(self, op: str, *args) -> None:
+        assert op == 'field' or op in OPS, f'unsupported operator {op}'
+        self.op = op
+        self.args = args
+        self.key = (op, ) + tuple(arg.key if isinstance(arg, Expr) else ('const', arg) for arg in args)
+
+    def children(self) -> list:
+        return [arg for arg in self.args if isinstance(arg, Expr)]
+
+    def __repr__(self) -> str:
+        if self.op == 'field':
+            return self.args[0]
+        if self.op in SYMBOLS:
+            return f'({self.args[0]} {SYMBOLS[self.op]} {self.args[1]})'
+        if self.op == 'neg':
+            return f'-{self.args[0]}'
+        return f"{self.op}({', '.join(map(repr, self.args))})"
+
+    def __add__(self, other):
+        return Expr('add', self, other)
+
+    def __radd__(self, other):
+        return Expr('add', other, self)
+
+    def __sub__(self, other):
+        return Expr('sub', self, other)
+
+    def __rsub__(self, other):
+        return Expr('sub', other, self)
+
+    def __mul__(self, other):
+        return Expr('mul', self, other)
+
+    def __rmul__(self, other):
+        return Expr('mul', other, self)
+
+    def __truediv__(self, other):
+        return Expr('div', self, other)
+
+    def __rtruediv__(self, other):
+        return Expr('div', other, self)
+
+    def __pow__(self, other):
+        return Expr('pow', self, other)
+
+    def __neg__(self):
+        return Expr('neg', self)
+
+    def __abs__(self):
+        return Expr('abs', self)
+
+
+# 构建表达式的函数, 参数含义与utils中对应的算子相同
+def field(name: str) -> Expr:
+    return Expr('field', name)
+
+def log(x: Expr) -> Expr:
+    return Expr('log', x)
+
+def sign(x: Expr) -> Expr:
+    return Expr('sign', x)
+
+def delay(x: Expr, d: int) -> Expr:
+    return Expr('delay', x, d)
+
+def delta(x: Expr, d: int) -> Expr:
+    return Expr('delta', x, d)
+
+def ts_sum(x: Expr, d: int) -> Expr:
+    return Expr('ts_sum', x, d)
+
+def ts_mean(x: Expr, d: int) -> Expr:
+    return Expr('ts_mean', x, d)
+
+def ts_std(x: Expr, d: int) -> Expr:
+    return Expr('ts_std', x, d)
+
+def ts_rank(x: Expr, d: int) -> Expr:
+    return Expr('ts_rank', x, d)
+
+def ts_corr(x: Expr, y: Expr, d: int) -> Expr:
+    return Expr('ts_corr', x, y, d)
+
+def decay_linear(x: Expr, d: int) -> Expr:
+    return Expr('decay_linear', x, d)
+
+def rank(x: Expr) -> Expr:
+    return Expr('rank', x)
+
+def zscore(x: Expr) -> Expr:
+    return Expr('zscore', x)
+
+def winsorize(x: Expr, n_std: float = 5) -> Expr:
+    return Expr('winsorize', x, n_std)
+
+
+class Engine:
+    '''
+    因子表达式的计算引擎: 批量计算多个因子表达式时, 所有表达式中结构相同的子表达式只计算一次,
+    中间结果保存在按最近使用顺序淘汰的缓存中, 之后计算的表达式也可以直接使用 \n
+    data: get_data得到的数据字典 \n
+    memory_budget: 缓存中间结果的内存上限(字节)
+    '''
+    def __init__(self, data, memory_budget: float = 2 ** 30) -> None:
+        self.data = data
+        self.memory_budget = memory_budget
+        self.cache = OrderedDict() # {表达式的key: 计算结果}
+        self.cache_size = 0 # 缓存占用的内存(字节)
+        self.n_computed = 0 # 累计计算的节点个数
+        self.index, self.columns = None, None
+
+    def get_field(self, name: str) -> np.ndarray:
+        '''
+        读取数据字段, 字段本身不放入缓存
+        '''
+        frame = self.data[name]
+        if self.index is None:
+            self.index, self.columns = frame.index, frame.columns
+        return frame.values
+
+    def put(self, key: tuple, value: np.ndarray) -> None:
+        '''
+        将计算结果放入缓存, 超出内存上限时淘汰最久未使用的结果
+        '''
+        if value.nbytes > self.memory_budget:
+            return
+        value.flags.writeable = False # 缓存的结果被多个表达式共享, 设为只读
+        self.cache[key] = value
+        self.cache_size += value.nbytes
+        while self.cache_size > self.memory_budget:
+            _, evicted = self.cache.popitem(last = False)
+            self.cache_size -= evicted.nbytes
+
+    def evaluate(self, exprs, as_frame: bool = True):
+        '''
+        计算因子表达式 \n
+        exprs: 一个表达式, 或{因子名称: 表达式}的字典 \n
+        as_frame: 若为True, 返回index为日期, columns为股票代码的pd.DataFrame, 否则返回np.ndarray \n
+        返回值与exprs的格式对应: 一个因子值, 或{因子名称: 因子值}的字典
+        '''
+        single = isinstance(exprs, Expr)
+        if single:
+            exprs = {None: exprs}
+
+        # 按拓扑顺序找到所有不同的节点, 并记录每个节点被多少个不同的父节点(或因子)使用
+        order, refcount, seen, values = [], {}, set(), {}
+        def visit(expr: Expr) -> None:
+            if expr.key in seen:
+                return
+            seen.add(expr.key)
+            if expr.key in self.cache: # 已缓存的节点直接取出, 不需要再访问其子节点
+                values[expr.key] = self.cache[expr.key]
+                self.cache.move_to_end(expr.key)
+                return
+            for child in {child.key: child for child in expr.children()}.values():
+                visit(child)
+                refcount[child.key] = refcount.get(child.key, 0) + 1
+            order.append(expr)
+        for expr in exprs.values():
+            visit(expr)
+        roots = {expr.key for expr in exprs.values()}
+
+        # 依次计算每个节点, 节点不再被之后的节点使用时释放
+        for expr in order:
+            if expr.op == 'field':
+                value = self.get_field(expr.args[0])
+            else:
+                args = [values[arg.key] if isinstance(arg, Expr) else arg for arg in expr.args]
+                with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                    value = np.asarray(OPS[expr.op](*args), dtype = np.float64)
+                self.n_computed += 1
+                self.put(expr.key, value)
+            values[expr.key] = value
+            for child in {child.key for child in expr.children()}:
+                refcount[child] -= 1
+                if refcount[child] == 0 and child not in roots:
+                    del values[child]
+
+        # 缓存中的结果和数据字段为只读且被共享, 返回副本, 使调用方可以原地修改因子值
+        res, returned = {}, set()
+        for name, expr in exprs.items():
+            res[name] = values[expr.key]
+            if not res[name].flags.writeable or expr.key in returned:
+                res[name] = res[name].copy()
+            returned.add(expr.key)
+            if as_frame:
+                res[name] = pd.DataFrame(res[name], index = self.index, columns = self.columns)
+        return res[None] if single else res
@@ -0,0 +1,160 @@
+import pandas as pd
+
+import json
+import time
+import threading
+import tracemalloc
+from typing import Optional
+
+ENABLED = False # 是否记录各阶段的运行信息, 关闭时stage直接返回空操作, 不产生额外开销
+MEMORY = False # 是否使用tracemalloc记录各阶段的内存峰值
+_records = [] # 已完成的阶段记录
+_local = threading.local() # 每个线程中正在运行的阶段
+_lock = threading.Lock()
+_run_id = 0 # 最外层阶段的编号, 同一次调用中的所有阶段属于同一个run
+_started_tracing = False # tracemalloc是否由本模块启动
+
+
+class _NullStage:
+    '''
+    关闭记录时使用的空阶段
+    '''
+    rows = cols = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage:
+    '''
+    一个阶段的记录: 运行时间, 处理的行数和列数, 内存峰值(相对于进入阶段时已分配的内存) \n
+    行数和列数可以在进入阶段后设置, 例如在计算出回测区间后设置rows \n
+    tracemalloc的峰值是进程级的, 重置峰值会影响所有线程中正在运行的阶段, 因此只记录主线程中阶段的内存峰值,
+    其中包括阶段运行期间后台线程(例如写入回测结果)分配的内存; 其他线程中阶段的内存峰值为NaN
+    '''
+    def __init__(self, name: str, rows: Optional[int] = None, cols: Optional[int] = None) -> None:
+        self.name = name
+        self.rows = rows
+        self.cols = cols
+
+    def __enter__(self):
+        global _run_id
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        if not stack:
+            with _lock:
+                _run_id += 1
+            self.run = _run_id
+        else:
+            self.run = stack[-1].run
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        self.base = None
+        if MEMORY and tracemalloc.is_tracing() and threading.current_thread() is threading.main_thread():
+            # 重置峰值前先将已有的峰值计入外层阶段
+            current, peak = tracemalloc.get_traced_memory()
+            for outer in stack:
+                outer.peak = max(outer.peak, peak)
+            tracemalloc.reset_peak()
+            self.base, self.peak = current, current
+        stack.append(self)
+        self.start = time.time()
+        self.counter = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        seconds = time.perf_counter() - self.counter
+        stack = _local.stack
+        stack.pop()
+        memory = None
+        if self.base is not None and tracemalloc.is_tracing():
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            for outer in stack:
+                outer.peak = max(outer.peak, self.peak)
+            memory = (self.peak - self.base) / 2 ** 20
+        record = {'run': self.run, 'stage': self.name, 'parent': self.parent, 'depth': self.depth,
+                  'start': self.start, 'seconds': seconds, 'rows': self.rows, 'cols': self.cols,
+                  'memory_mb': memory, 'thread': threading.current_thread().name}
+        with _lock:
+            _records.append(record)
+
+
+def stage(name: str, rows: Optional[int] = None, cols: Optional[int] = None):
+    '''
+    记录一个阶段, 用法为with stage('backtest.align', rows, cols) as s: ..., 未开启记录时不做任何事 \n
+    name: 阶段名称, 以'模块.步骤'命名 \n
+    rows, cols: 该阶段处理的行数(日期数)和列数(股票数)
+    '''
+    if not ENABLED:
+        return _NULL_STAGE
+    return Stage(name, rows, cols)
+
+
+def enable(memory: bool = True) -> None:
+    '''
+    开启记录 \n
+    memory: 是否记录内存峰值, 需要启动tracemalloc, 会使计算变慢
+    '''
+    global ENABLED, MEMORY, _started_tracing
+    ENABLED, MEMORY = True, memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracing = True
+
+
+def disable() -> None:
+    '''
+    关闭记录, 已有的记录保留
+    '''
+    global ENABLED, MEMORY, _started_tracing
+    ENABLED, MEMORY = False, False
+    if _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+
+
+def reset() -> None:
+    '''
+    清空已有的记录
+    '''
+    with _lock:
+        _records.clear()
+
+
+def report() -> pd.DataFrame:
+    '''
+    返回所有阶段的记录, 每个阶段一行, 包括run编号, 阶段名称, 外层阶段, 开始时间, 运行时间(秒), 行数, 列数,
+    内存峰值(MB, 只记录主线程中的阶段)和线程名称
+    '''
+    with _lock:
+        return pd.DataFrame(list(_records), columns = ['run', 'stage', 'parent', 'depth', 'start', 'seconds',
+                                                       'rows', 'cols', 'memory_mb', 'thread'])
+
+
+def summary() -> pd.DataFrame:
+    '''
+    按阶段名称汇总: 调用次数, 总时间, 平均时间, 最长时间和最大内存峰值, 按总时间降序排列
+    '''
+    res = report().groupby('stage').agg(count = ('seconds', 'size'), total = ('seconds', 'sum'),
+                                        mean = ('seconds', 'mean'), max = ('seconds', 'max'),
+                                        memory_mb = ('memory_mb', 'max'))
+    return res.sort_values('total', ascending = False)
+
+
+def export(FILE_PATH: str) -> None:
+    '''
+    将记录导出为Chrome trace格式的json文件, 可以在chrome://tracing或Perfetto中查看各阶段的时间线
+    '''
+    events = []
+    for record in report().to_dict('records'):
+        args = {key: record[key] for key in ['run', 'rows', 'cols', 'memory_mb'] if pd.notna(record[key])}
+        events.append({'name': record['stage'], 'ph': 'X', 'ts': record['start'] * 1e6,
+                       'dur': record['seconds'] * 1e6, 'pid': 0, 'tid': record['thread'], 'args': args})
+    with open(FILE_PATH, 'w') as f:
+        json.dump({'traceEvents': events}, f, default = float)
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+import os
+import hashlib
+from typing import Optional
+
+_UNIVERSES = {} # 进程内缓存的内置资产池: {(资产池文件路径, 修改时间, 日期, 股票代码的哈希值): Universe}
+
+
+class Universe:
+    '''
+    资产池的成分股索引: 每个日期只记录成分股所在的列, 以shape = (T, M)的整数数组idx储存,
+    M为单日成分股个数的最大值, 不足M个时以-1补齐, 例如沪深300的M约为300, 而不是全市场的约5000只股票 \n
+    members: index为日期, columns为股票代码的资产池, 值为1表示该股票在资产池内
+    '''
+    def __init__(self, members: pd.DataFrame) -> None:
+        self.index = members.index
+        self.columns = members.columns
+        mask = (members == 1).values
+        self.count = mask.sum(axis = 1) # 每个日期的成分股个数
+        M = max(int(self.count.max()) if len(mask) > 0 else 0, 1)
+        order = np.argsort(~mask, axis = 1, kind = 'stable')[:, :M] # 成分股排在前面, 按列的顺序排列
+        self.idx = np.where(np.arange(M) < self.count[:, None], order, -1).astype(np.int32)
+        h = hashlib.blake2b(digest_size = 16) # 资产池内容的哈希值, 用于回测结果缓存的键
+        h.update(self.idx)
+        h.update(np.asarray(self.index.values, dtype = 'datetime64[ns]'))
+        h.update('\n'.join(map(str, self.columns)).encode())
+        self.key = h.hexdigest()
+
+    def members(self, dates: pd.Index, columns: pd.Index) -> np.ndarray:
+        '''
+        返回各日期成分股在columns中的位置, shape = (len(dates), M),
+        不在资产池内的日期, 不在columns中的股票和补齐的位置为-1
+        '''
+        rows = self.index.get_indexer(dates)
+        idx = np.where((rows >= 0)[:, None], self.idx[rows], -1)
+        cols = columns.get_indexer(self.columns)
+        return np.where(idx >= 0, cols[idx], -1)
+
+    def where(self, frame: pd.DataFrame) -> pd.DataFrame:
+        '''
+        保留资产池内股票的值, 其余为NaN, 与frame[pool == 1]等价
+        '''
+        cols = self.members(frame.index, frame.columns)
+        rows = np.broadcast_to(np.arange(len(frame))[:, None], cols.shape)
+        valid = cols >= 0
+        values = np.full(frame.shape, np.nan)
+        values[rows[valid], cols[valid]] = frame.values[rows[valid], cols[valid]]
+        return pd.DataFrame(values, index = frame.index, columns = frame.columns)
+
+
+def take(values: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    '''
+    按位置取出values中的值, 位置为-1时为NaN \n
+    rows: shape = (T, )的行位置 \n
+    cols: shape = (N, )的列位置(所有行相同), 或shape = (T, M)的每行各自的列位置, 为None时取所有列
+    '''
+    # 使用索引而不是values.take: 对pandas计算得到的按列存储(F-order)的数组, take会先复制整个数组
+    r = np.maximum(rows, 0)
+    if cols is None:
+        out = values[r].astype(np.float64, copy = False)
+    else:
+        out = values[r[:, None], np.maximum(cols, 0)].astype(np.float64, copy = False)
+        out[np.broadcast_to(cols < 0, out.shape)] = np.nan
+    out[rows < 0] = np.nan
+    return out
+
+
+def load_universe(PATH: str, pool_name: str, index: pd.Index, columns: pd.Index) -> Optional[Universe]:
+    '''
+    读取内置资产池, 并对齐到数据集的日期和股票代码, 每个资产池文件在进程内只构建一次索引 \n
+    PATH: 存储数据的路径, 设置为本repo的路径 \n
+    pool_name: 资产池名称, 'all'返回None, 'hs300'读取PATH/newdata/hs300.csv
+    '''
+    if pool_name == 'all':
+        return None
+    FILE_PATH = os.path.realpath(os.path.join(PATH, f'newdata/{pool_name}.csv'))
+    h = hashlib.blake2b(digest_size = 16)
+    h.update(np.asarray(index.values, dtype = 'datetime64[ns]'))
+    h.update('\n'.join(map(str, columns)).encode())
+    key = (FILE_PATH, os.path.getmtime(FILE_PATH), h.hexdigest())
+    if key not in _UNIVERSES:
+        pool = pd.read_csv(FILE_PATH, index_col = 0)
+        pool.index = pd.to_datetime(pool.index)
+        _UNIVERSES[key] = Universe(pool.reindex(index = index, columns = columns))
+    return _UNIVERSES[key]
@@ -1,30 +1,355 @@
 import numpy as np
 import pandas as pd
 
+import functools
+import warnings
+from typing import Optional
+
+def _rank_rows(x: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    '''
+    对shape = (rows, N)的x逐行排序, 相同值取平均排名, 仅mask为True的位置参与排序
+    '''
+    x = np.where(mask, x, np.nan) # 不参与排序的位置设为NaN, 排序时位于末尾
+    order = np.argsort(x, axis = -1) # 相同值取平均排名, 不需要稳定排序
+    sorted_x = np.take_along_axis(x, order, axis = -1)
+    N = x.shape[-1]
+    pos = np.arange(N, dtype = np.int32)
+    tie = sorted_x[:, 1:] == sorted_x[:, :-1]
+    if tie.any(): # 相同值构成一组, 计算每组在排序后的起止位置, 组内取平均排名
+        is_start = np.ones(x.shape, dtype = bool)
+        is_start[:, 1:] = ~tie
+        is_end = np.ones(x.shape, dtype = bool)
+        is_end[:, :-1] = is_start[:, 1:]
+        start = np.maximum.accumulate(np.where(is_start, pos, 0).astype(np.int32), axis = -1)
+        end = np.minimum.accumulate(np.where(is_end, pos, N).astype(np.int32)[:, ::-1], axis = -1)[:, ::-1]
+        ranks = (start + end) / 2 + 1
+    else:
+        ranks = np.broadcast_to(pos + 1.0, x.shape)
+    rank = np.empty(x.shape, dtype = np.float64)
+    np.put_along_axis(rank, order, ranks, axis = -1)
+    rank[~mask] = np.nan
+    return rank
+
+def cs_rank(x: np.ndarray, mask: Optional[np.ndarray] = None, block_size: int = 2 ** 16) -> np.ndarray:
+    '''
+    截面排序: 沿最后一维计算排名(从1开始), 相同值取平均排名, 与pd.Series.rank(method = 'average')一致 \n
+    x: shape = (..., N)的np.ndarray, 例如shape = (T, N)的因子值或shape = (K, T, N)的多个因子 \n
+    mask: 与x同shape的bool数组, 仅mask为True的位置参与排序, 其余位置结果为NaN; 
+    若为None, 则使用x中非NaN的位置 \n
+    block_size: 每次排序的元素个数, 按行分块排序, 临时数组较小, 可以提高缓存命中率
+    '''
+    x = np.asarray(x, dtype = np.float64)
+    if mask is None:
+        mask = ~np.isnan(x)
+    N = x.shape[-1] if x.ndim > 0 else 1
+    rows, row_mask = x.reshape(-1, N), np.broadcast_to(mask, x.shape).reshape(-1, N)
+    rank = np.empty(rows.shape, dtype = np.float64)
+    step = max(block_size // max(N, 1), 1)
+    for s in range(0, len(rows), step):
+        rank[s: s + step] = _rank_rows(rows[s: s + step], row_mask[s: s + step])
+    return rank.reshape(x.shape)
+
+def _cs_corr(x: np.ndarray, y: np.ndarray, method: str) -> np.ndarray:
+    '''
+    cs_corr在一块日期上的计算
+    '''
+    x, y = np.broadcast_arrays(x, y)
+    mask = ~(np.isnan(x) | np.isnan(y)) # 两者均有效的样本
+    if method == 'spearman': # 在共同有效的样本上排序
+        x = cs_rank(x, mask)
+        y = cs_rank(y, mask)
+    n = mask.sum(axis = -1)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        x_mean = np.where(mask, x, 0).sum(axis = -1) / n
+        y_mean = np.where(mask, y, 0).sum(axis = -1) / n
+        x_c = np.where(mask, x - x_mean[..., None], 0)
+        y_c = np.where(mask, y - y_mean[..., None], 0)
+        res = np.asarray((x_c * y_c).sum(axis = -1) / np.sqrt((x_c ** 2).sum(axis = -1) * (y_c ** 2).sum(axis = -1)))
+    res[n < 2] = np.nan
+    return np.clip(res, -1, 1)
+
+def cs_corr(x: np.ndarray, y: np.ndarray, method: str = 'pearson', block_size: int = 2 ** 18) -> np.ndarray:
+    '''
+    计算x和y在每个截面(最后一维)上的相关系数, 仅使用x和y均非NaN的样本, 样本数不足2时结果为NaN \n
+    x, y: 可广播的np.ndarray, 例如x为shape = (K, T, N)的多个因子, y为shape = (T, N)的收益率, 
+    此时返回shape = (K, T)的每日相关系数 \n
+    method: 'pearson'(IC)或'spearman'(rankIC) \n
+    block_size: 每块的元素个数, 按日期(倒数第二维)分块计算, 临时数组的大小只取决于块的大小
+    '''
+    assert method in ['pearson', 'spearman'], "method should be 'pearson' or 'spearman'"
+    x, y = np.asarray(x, dtype = np.float64), np.asarray(y, dtype = np.float64)
+    shape = np.broadcast_shapes(x.shape, y.shape)
+    if len(shape) < 2:
+        return _cs_corr(x, y, method)
+    T = shape[-2]
+    step = max(block_size // max(int(np.prod(shape)) // max(T, 1), 1), 1)
+    if step >= T:
+        return _cs_corr(x, y, method)
+    res = np.empty(shape[:-1])
+    for s in range(0, T, step): # 只对倒数第二维不为1的数组分块, 其余数组沿该维广播
+        x_block = x if x.ndim < 2 or x.shape[-2] == 1 else x[..., s: s + step, :]
+        y_block = y if y.ndim < 2 or y.shape[-2] == 1 else y[..., s: s + step, :]
+        res[..., s: s + step] = _cs_corr(x_block, y_block, method)
+    return res
+
 def corr(x: pd.DataFrame, y: pd.DataFrame) -> pd.DataFrame:
     '''
     计算x和y在每个截面上相关系数的均值, x, y的index须相同 
     '''
     assert list(x.index) == list(y.index), 'x and y should have the same index'
-    res = pd.Series(index = x.index)
-    for date in x.index:
-        res.loc[date] = x.loc[date].corr(y.loc[date])
+    res = pd.Series(cs_corr(x.values, y.reindex(columns = x.columns).values), index = x.index)
     return res.mean()
 
 def zscore(x: pd.DataFrame) -> pd.DataFrame:
     '''
     z-score标准化
     '''
-    return ((x.T - x.mean(axis = 1)) / x.std(axis = 1)).T
+    return pd.DataFrame(cs_zscore(x.values), index = x.index, columns = x.columns)
 
 def cleanOutlier(x: pd.DataFrame) -> pd.DataFrame:
     '''
     去极值, 将极值压缩到均值 +/- 5倍标准差
     '''
-    y = x.copy()
-    mean = x.mean(axis = 1)
-    std = x.std(axis = 1)
-    for date in y.index:
-        y.loc[date, y.loc[date] > mean.loc[date] + 5 * std.loc[date]] = mean.loc[date] + 5 * std.loc[date]
-        y.loc[date, y.loc[date] < mean.loc[date] - 5 * std.loc[date]] = mean.loc[date] - 5 * std.loc[date]
-    return y
\ No newline at end of file
+    return pd.DataFrame(cs_winsorize(x.values, 5), index = x.index, columns = x.columns)
+
+
+# 下面为因子算子, 输入输出均为shape = (T, N)的np.ndarray, 缺失值为NaN
+
+def _cs_mean_std(x: np.ndarray) -> (np.ndarray, np.ndarray):
+    '''
+    每个截面上非NaN值的均值和标准差(ddof = 1), 与pd.DataFrame.mean(axis = 1), std(axis = 1)一致
+    '''
+    mask = ~np.isnan(x)
+    n = mask.sum(axis = 1, keepdims = True)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        mean = np.where(mask, x, 0).sum(axis = 1, keepdims = True) / n
+        std = np.sqrt((np.where(mask, x - mean, 0) ** 2).sum(axis = 1, keepdims = True) / (n - 1))
+    std[n < 2] = np.nan
+    return mean, std
+
+def cs_zscore(x: np.ndarray) -> np.ndarray:
+    '''
+    截面z-score标准化
+    '''
+    x = np.asarray(x, dtype = np.float64)
+    mean, std = _cs_mean_std(x)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return (x - mean) / std
+
+def cs_winsorize(x: np.ndarray, n_std: float = 5) -> np.ndarray:
+    '''
+    截面去极值, 将极值压缩到均值 +/- n_std倍标准差, 标准差为NaN的截面不处理
+    '''
+    x = np.asarray(x, dtype = np.float64)
+    mean, std = _cs_mean_std(x)
+    upper, lower = mean + n_std * std, mean - n_std * std
+    with np.errstate(invalid = 'ignore'):
+        return np.where(x > upper, upper, np.where(x < lower, lower, x))
+
+def neutralize(x: np.ndarray, industry: Optional[np.ndarray] = None, exposures: Optional[list] = None) -> np.ndarray:
+    '''
+    截面中性化: 在每个截面上将x对行业哑变量(无行业时为截距项)和exposures做线性回归, 返回残差 \n
+    industry: shape = (T, N)或(N,)的行业编号(非负整数), 负数表示行业缺失 \n
+    exposures: 需要中性化的风格暴露, 例如[对数市值], 每个元素为shape = (T, N)的np.ndarray
+    '''
+    x = np.asarray(x, dtype = np.float64)
+    T, N = x.shape
+    exposures = [] if exposures is None else [np.asarray(e, dtype = np.float64) for e in exposures]
+    mask = ~np.isnan(x)
+    for e in exposures:
+        mask &= ~np.isnan(e)
+    if industry is None:
+        group = np.zeros((T, N), dtype = np.int64)
+    else:
+        group = np.broadcast_to(np.asarray(industry), (T, N)).astype(np.int64)
+        mask &= group >= 0
+    n_group = group.max() + 1 if group.size > 0 else 1
+    flat_group = (np.arange(T)[:, None] * n_group + np.where(mask, group, 0)).ravel()
+
+    def demean(v: np.ndarray) -> np.ndarray: # 减去每个截面上所在行业的均值(去掉行业哑变量的影响)
+        v = np.where(mask, v, 0)
+        count = np.bincount(flat_group, weights = mask.ravel(), minlength = T * n_group)
+        total = np.bincount(flat_group, weights = v.ravel(), minlength = T * n_group)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            mean = (total / count)[flat_group].reshape(T, N)
+        return np.where(mask, v - mean, 0)
+
+    resid = demean(x)
+    if len(exposures) > 0: # 对去掉行业均值后的风格暴露做批量最小二乘回归
+        E = np.stack([demean(e) for e in exposures], axis = -1)
+        beta = np.einsum('tkl,tl->tk', np.linalg.pinv(np.einsum('tnk,tnl->tkl', E, E)), np.einsum('tnk,tn->tk', E, resid))
+        resid = resid - np.einsum('tnk,tk->tn', E, beta)
+    resid[~mask] = np.nan
+    return resid
+
+def delay(x: np.ndarray, d: int) -> np.ndarray:
+    '''
+    d天前的值, 与pd.DataFrame.shift(d)一致
+    '''
+    x = np.asarray(x, dtype = np.float64)
+    res = np.full(x.shape, np.nan)
+    if d < len(x):
+        res[d:] = x[:len(x) - d]
+    return res
+
+def delta(x: np.ndarray, d: int) -> np.ndarray:
+    '''
+    与d天前的差值
+    '''
+    return x - delay(x, d)
+
+def _rolling_sum(x: np.ndarray, d: int) -> np.ndarray:
+    '''
+    过去d天(含当天)的和, x中不能有NaN. 将日期按d天分块, 每天的窗口和为当前块内的前缀和加上前一块内的后缀和,
+    计算量与d无关; 累积和每d天重新开始, 舍入误差不会影响之后所有的窗口
+    '''
+    T = len(x)
+    if d >= T: # 所有窗口都从第一天开始
+        return np.cumsum(x, axis = 0)
+    pad = (-T) % d
+    blocks = np.concatenate([x, np.zeros((pad, ) + x.shape[1:], dtype = x.dtype)]).reshape((-1, d) + x.shape[1:])
+    res = np.cumsum(blocks, axis = 1) # 块内前缀和
+    res[1:, :d - 1] += np.cumsum(blocks[:-1, ::-1], axis = 1)[:, ::-1][:, 1:] # 前一块内的后缀和
+    return res.reshape((-1, ) + x.shape[1:])[:T]
+
+def _ts_count(mask: np.ndarray, d: int) -> np.ndarray:
+    '''
+    过去d天(含当天)窗口内mask为True的个数
+    '''
+    return _rolling_sum(mask.astype(np.int64), d)
+
+def _ts_center(x: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    '''
+    减去每只股票mask为True的有限值的中位数(在等间隔抽取的至多64天中计算), 其他位置(NaN和inf)设为0, 以减小舍入误差;
+    使用中位数, 个别极端值不会改变其他窗口的参考值和精度
+    '''
+    finite = mask & np.isfinite(x)
+    step = max(1, len(x) // 64)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # 抽取的日期中全部为NaN的股票
+        ref = np.nan_to_num(np.nanmedian(np.where(finite[::step], x[::step], np.nan), axis = 0))
+    return np.where(finite, x - ref, 0), ref
+
+def _ts_inf(res: np.ndarray, x: np.ndarray, mask: np.ndarray, d: int) -> None:
+    '''
+    将过去d天(含当天)窗口内包含inf(mask为True的位置)的结果设为NaN, 与pandas一致; 不包含inf的窗口不受影响
+    '''
+    inf = mask & np.isinf(x)
+    if inf.any():
+        res[_ts_count(inf, d) > 0] = np.nan
+
+def _column_blocks(func):
+    '''
+    时序算子按股票(列)分块计算: 各列的计算相互独立, 分块后临时数组较小, 可以复用内存并提高缓存命中率
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, block_size: int = 256, **kwargs):
+        n_arrays = 0 # 开头的数组参数个数
+        while n_arrays < len(args) and isinstance(args[n_arrays], (np.ndarray, pd.DataFrame)):
+            n_arrays += 1
+        arrays = [np.asarray(a, dtype = np.float64) for a in args[: n_arrays]]
+        N = arrays[0].shape[1]
+        if N <= block_size:
+            return func(*arrays, *args[n_arrays:], **kwargs)
+        res = np.empty(arrays[0].shape)
+        for i in range(0, N, block_size):
+            block = [np.ascontiguousarray(a[:, i: i + block_size]) for a in arrays]
+            res[:, i: i + block_size] = func(*block, *args[n_arrays:], **kwargs)
+        return res
+    return wrapper
+
+@_column_blocks
+def ts_sum(x: np.ndarray, d: int, min_periods: Optional[int] = None) -> np.ndarray:
+    '''
+    过去d天(含当天)的和, 窗口内非NaN值个数少于min_periods(默认为d)时为NaN, 与pd.DataFrame.rolling(d).sum()一致
+    '''
+    mask = ~np.isnan(x)
+    x_c, ref = _ts_center(x, mask)
+    count = _ts_count(mask, d)
+    res = _rolling_sum(x_c, d) + count * ref
+    _ts_inf(res, x, mask, d)
+    res[count < (d if min_periods is None else min_periods)] = np.nan
+    return res
+
+@_column_blocks
+def ts_mean(x: np.ndarray, d: int, min_periods: Optional[int] = None) -> np.ndarray:
+    '''
+    过去d天(含当天)的均值, 与pd.DataFrame.rolling(d).mean()一致
+    '''
+    mask = ~np.isnan(x)
+    x_c, ref = _ts_center(x, mask)
+    count = _ts_count(mask, d)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        res = _rolling_sum(x_c, d) / count + ref
+    _ts_inf(res, x, mask, d)
+    res[count < (d if min_periods is None else min_periods)] = np.nan
+    return res
+
+@_column_blocks
+def ts_std(x: np.ndarray, d: int, min_periods: Optional[int] = None) -> np.ndarray:
+    '''
+    过去d天(含当天)的标准差(ddof = 1), 与pd.DataFrame.rolling(d).std()一致
+    '''
+    mask = ~np.isnan(x)
+    x_c, _ = _ts_center(x, mask)
+    count = _ts_count(mask, d)
+    s2 = _rolling_sum(x_c ** 2, d)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        ss = s2 - _rolling_sum(x_c, d) ** 2 / count # 离差平方和
+        ss[ss <= 1e-10 * s2] = 0 # 窗口内的值全部相同
+        res = np.sqrt(ss / (count - 1))
+    _ts_inf(res, x, mask, d)
+    res[count < max(2, d if min_periods is None else min_periods)] = np.nan
+    return res
+
+@_column_blocks
+def ts_rank(x: np.ndarray, d: int, min_periods: Optional[int] = None) -> np.ndarray:
+    '''
+    当天的值在过去d天(含当天)中的排名(从1开始, 相同值取平均排名), 与pd.DataFrame.rolling(d).rank()一致
+    '''
+    less = np.zeros(x.shape)
+    equal = np.zeros(x.shape)
+    for k in range(min(d, len(x))):
+        lag = x[:len(x) - k]
+        less[k:] += lag < x[k:]
+        equal[k:] += lag == x[k:]
+    res = less + (equal + 1) / 2
+    res[np.isnan(x) | (_ts_count(~np.isnan(x), d) < (d if min_periods is None else min_periods))] = np.nan
+    return res
+
+@_column_blocks
+def ts_corr(x: np.ndarray, y: np.ndarray, d: int, min_periods: Optional[int] = None) -> np.ndarray:
+    '''
+    x和y过去d天(含当天)的相关系数, 仅使用x和y均非NaN的样本, 与pd.DataFrame.rolling(d).corr()一致, 
+    窗口内x或y的值全部相同时为NaN
+    '''
+    mask = ~(np.isnan(x) | np.isnan(y))
+    x_c, _ = _ts_center(x, mask)
+    y_c, _ = _ts_center(y, mask)
+    count = _ts_count(mask, d)
+    x_sum, y_sum = _rolling_sum(x_c, d), _rolling_sum(y_c, d)
+    x_s2, y_s2 = _rolling_sum(x_c ** 2, d), _rolling_sum(y_c ** 2, d)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        x_ss = x_s2 - x_sum ** 2 / count
+        y_ss = y_s2 - y_sum ** 2 / count
+        xy_ss = _rolling_sum(x_c * y_c, d) - x_sum * y_sum / count
+        res = xy_ss / np.sqrt(x_ss * y_ss)
+    _ts_inf(res, x, mask, d)
+    _ts_inf(res, y, mask, d)
+    res[(count < max(2, d if min_periods is None else min_periods)) | (x_ss <= 1e-10 * x_s2) | (y_ss <= 1e-10 * y_s2)] = np.nan
+    return np.clip(res, -1, 1)
+
+@_column_blocks
+def decay_linear(x: np.ndarray, d: int, min_periods: Optional[int] = None) -> np.ndarray:
+    '''
+    过去d天(含当天)的线性衰减加权平均, 当天权重为d, d-1天前权重为1, 忽略NaN并对权重重新归一化
+    '''
+    mask = ~np.isnan(x)
+    total, weight = np.zeros(x.shape), np.zeros(x.shape)
+    for k in range(min(d, len(x))):
+        total[k:] += (d - k) * np.where(mask[:len(x) - k], x[:len(x) - k], 0)
+        weight[k:] += (d - k) * mask[:len(x) - k]
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        res = total / weight
+    res[_ts_count(mask, d) < (d if min_periods is None else min_periods)] = np.nan
+    return res
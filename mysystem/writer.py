@@ -0,0 +1,104 @@
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import atexit
+import queue
+import weakref
+import threading
+from typing import Callable
+from . import profiler
+
+MAX_QUEUE = 64 # 等待写入的任务个数上限, 队列已满时提交任务会等待, 避免待写入的结果占用过多内存
+_queue = None # 进程内所有写入器共享的任务队列, 由一个后台线程依次执行, 首次使用时创建
+_lock = threading.Lock()
+_writers = weakref.WeakSet() # 仍然存在的写入器, 退出前报告未抛出的异常
+
+
+def _run(tasks: queue.Queue) -> None:
+    '''
+    后台线程: 依次执行队列中的写入任务, 异常记录在提交任务的写入器中
+    '''
+    while True:
+        writer, func, args, kwargs = tasks.get()
+        try:
+            with profiler.stage(f'writer.{func.__name__}'):
+                func(*args, **kwargs)
+        except Exception as e:
+            writer.errors.append(e)
+        finally:
+            del writer, func, args, kwargs # 任务完成后不再引用写入器和待写入的数据
+            tasks.task_done()
+
+
+def _get_queue() -> queue.Queue:
+    '''
+    获取共享的任务队列, 首次调用时启动后台线程, 并注册退出前写完队列中的结果
+    '''
+    global _queue
+    with _lock:
+        if _queue is None:
+            _queue = queue.Queue(maxsize = MAX_QUEUE)
+            threading.Thread(target = _run, args = (_queue, ), daemon = True).start()
+            atexit.register(_flush_all)
+        return _queue
+
+
+def _flush_all() -> None:
+    '''
+    退出前写完队列中的结果, 并打印尚未通过flush抛出的异常
+    '''
+    _queue.join()
+    for writer in list(_writers):
+        for e in writer.errors:
+            print(f'Failed to write backtest results: {e!r}')
+        writer.errors = []
+
+
+class ArtifactWriter:
+    '''
+    回测结果的后台写入器: csv和图片在后台线程中写入, 计算部分在结果算出后即可返回 \n
+    进程内所有写入器共享同一个后台线程和任务队列, 创建大量Backtest(包括每个AlphaPool中的Backtest)不会增加线程 \n
+    图片使用非交互式的Agg后端绘制, 不经过pyplot, 保存后即释放, 不会随着回测次数增加而累积 \n
+    render: 是否绘制图片, 设置为False时(批量模式)跳过所有绘图
+    '''
+    def __init__(self, render: bool = True) -> None:
+        self.render = render
+        self.errors = [] # 后台写入时出现的异常, 在flush时抛出
+        _writers.add(self)
+
+    def submit(self, func: Callable, *args, **kwargs) -> None:
+        '''
+        提交一个写入任务
+        '''
+        _get_queue().put((self, func, args, kwargs))
+
+    def write_csv(self, data, FILE_PATH: str, copy: bool = True, **kwargs) -> None:
+        '''
+        写入csv文件, copy为True时先复制data, 提交后调用方可以继续修改data
+        '''
+        if copy:
+            data = data.copy()
+        self.submit(data.to_csv, FILE_PATH, **kwargs)
+
+    def plot(self, draw: Callable, FILE_PATH: str, figsize: tuple = (8, 4)) -> None:
+        '''
+        绘制并保存图片: draw为接收matplotlib Axes并在其上绘图的函数, 批量模式下不绘制
+        '''
+        if self.render:
+            self.submit(self.save_figure, draw, FILE_PATH, figsize)
+
+    def save_figure(self, draw: Callable, FILE_PATH: str, figsize: tuple) -> None:
+        fig = Figure(figsize = figsize)
+        FigureCanvasAgg(fig)
+        draw(fig.add_subplot())
+        fig.savefig(FILE_PATH)
+        fig.clear()
+
+    def flush(self) -> None:
+        '''
+        等待队列中的结果全部写入, 若本写入器的任务出现异常则抛出第一个异常
+        '''
+        _get_queue().join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]